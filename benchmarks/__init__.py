@@ -0,0 +1 @@
+# Benchmarks are run as modules, e.g. `python -m benchmarks.suite`
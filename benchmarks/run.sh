@@ -0,0 +1,15 @@
+#! /usr/bin/env bash
+# Runs the benchmark suite against the test database (see tests/test.sh).
+# The history is written to benchmarks/results.jsonl on the host. Arguments are passed to the suite.
+trap "docker-compose -f tests/docker-compose.yml down -v --remove-orphans" EXIT
+
+# Exit in case of error
+set -e
+
+docker-compose -f tests/docker-compose.yml down -v --remove-orphans
+docker-compose -f tests/docker-compose.yml build
+docker-compose -f tests/docker-compose.yml up -d db
+docker-compose -f tests/docker-compose.yml run --rm \
+    -v "$(pwd)/benchmarks:/src/benchmarks" \
+    --entrypoint tests/_wait_for_it.sh \
+    tester -q db:5432 -- python -m benchmarks.suite "$@"
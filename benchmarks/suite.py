@@ -0,0 +1,317 @@
+"""
+Benchmarks of code generation, flushing and diffing, parameterized over the size of the registry,
+the length of function bodies and the size of the GD script, and of calling functions
+that look GD objects up against functions with the objects inlined (see plpy_func's inline_gd).
+Code generation is also timed with function bodies extracted by inspect (a getsource and a parse
+per function) instead of sliced from the source index (one parse per module).
+
+Every run is appended to a history file (benchmarks/results.jsonl by default) and each result
+is compared with the last recorded result of the same benchmark.
+The flush benchmarks need the Postgres database the tests use (see tests/docker-compose.yml and
+benchmarks/run.sh); they are skipped when the database can't be reached.
+
+Usage: python -m benchmarks.suite [--registry-sizes 10 100 1000 10000] [--calls 1000 100000]
+                                 [--repeat 3] [--skip-db]
+"""
+import argparse
+import datetime as dt
+import importlib.util
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+from unittest import mock
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+import plpy_man
+from plpy_man.manager import _inspect_function, _prep_gd_script, _source_index, _to_sql
+
+_RESULTS = Path(__file__).with_name("results.jsonl")
+_PREFIX = "bench_func_"
+
+_FUNCTION = '''
+def {prefix}{i}(a: int, b: int) -> int:
+    """ Generated function {i} """
+    total = 0
+    for x in range(a):
+{lines}
+    return total
+'''
+_LINE = "        total += x * b + {j}\n"
+
+
+def _write_module(directory: Path, count: int, body_lines: int, prefix: str) -> ModuleType:
+    """ Writes (and imports) a module of `count` functions, each with a loop of `body_lines` """
+    lines = "".join(_LINE.format(j=j) for j in range(body_lines)).rstrip("\n")
+    source = "".join(_FUNCTION.format(prefix=prefix, i=i, lines=lines) for i in range(count))
+    path = directory / f"{prefix}{count}_{body_lines}.py"
+    path.write_text(source)
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)  # type: ignore
+    return module
+
+
+def _functions(module: ModuleType, count: int, prefix: str) -> List[Callable]:
+    return [getattr(module, f"{prefix}{i}") for i in range(count)]
+
+
+def _best(run: Callable[[], Any], repeat: int, setup: Callable[[], Any] = lambda: None) -> float:
+    """ The fastest of `repeat` runs, each starting with a cold source index """
+    best = float("inf")
+    for _ in range(repeat):
+        setup()
+        _source_index.clear()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    _source_index.clear()
+    return best
+
+
+def _codegen_benchmarks(
+    directory: Path, registry_sizes: Sequence[int], body_lines: Sequence[int], repeat: int
+) -> Iterator[Dict[str, Any]]:
+    for count in registry_sizes:
+        funcs = _functions(_write_module(directory, count, 5, _PREFIX), count, _PREFIX)
+        params = {"functions": count, "body_lines": 5}
+        yield {
+            "name": "inspect_function",
+            "params": params,
+            "seconds": _best(lambda: [_inspect_function(f) for f in funcs], repeat),
+        }
+        yield {
+            "name": "to_sql",
+            "params": params,
+            "seconds": _best(lambda: [_to_sql(f) for f in funcs], repeat),
+        }
+        with mock.patch.object(_source_index, "body", return_value=None):
+            yield {
+                "name": "to_sql_inspect",
+                "params": params,
+                "seconds": _best(lambda: [_to_sql(f) for f in funcs], repeat),
+            }
+    for lines in body_lines:
+        if lines == 5 and 100 in registry_sizes:
+            continue  # Measured above
+        funcs = _functions(_write_module(directory, 100, lines, _PREFIX), 100, _PREFIX)
+        yield {
+            "name": "to_sql",
+            "params": {"functions": 100, "body_lines": lines},
+            "seconds": _best(lambda: [_to_sql(f) for f in funcs], repeat),
+        }
+
+
+def _gd_benchmarks(
+    directory: Path, gd_sizes: Sequence[int], repeat: int
+) -> Iterator[Dict[str, Any]]:
+    for count in gd_sizes:
+        objs = _functions(_write_module(directory, count, 5, "gd_func_"), count, "gd_func_")
+        yield {
+            "name": "prep_gd_script",
+            "params": {"objects": count},
+            "seconds": _best(lambda: _prep_gd_script(objs), repeat),
+        }
+
+
+def _gd_helper(x):
+    return x * 2 + 1
+
+
+def _gd_caller() -> Callable:
+    # The GD objects are looked up (or inlined) in the body; the functions are never called
+    def call_gd_helper(x: int) -> int:
+        return GD["_gd_helper"](x) + GD["_gd_helper"](x + 1)  # type: ignore # noqa: F821
+
+    return call_gd_helper
+
+
+def _inlining_manager(inline_gd: bool) -> plpy_man.PlpyMan:
+    manager = plpy_man.PlpyMan()
+    manager.to_gd(_gd_helper)
+    manager.plpy_func(_gd_caller(), inline_gd=inline_gd)
+    return manager
+
+
+def _call_benchmarks(calls: Sequence[int], repeat: int) -> Iterator[Dict[str, Any]]:
+    """ Calls the generated function bodies in this process, the way PlPython calls them """
+    for inline_gd in (False, True):
+        sql = "".join(_inlining_manager(inline_gd)._compile()["call_gd_helper"])
+        body = sql.split("AS $$\n")[1].split("$$ LANGUAGE")[0]
+        namespace: Dict[str, Any] = {"GD": {"_gd_helper": _gd_helper}, "SD": {}, "plpy": None}
+        exec(f"def procedure():\n{body}", namespace)
+        procedure = namespace["procedure"]
+
+        def run() -> None:
+            for x in range(count):
+                namespace["x"] = x  # Arguments are globals
+                procedure()
+
+        for count in calls:
+            yield {
+                "name": "call",
+                "params": {"calls": count, "inline_gd": inline_gd},
+                "seconds": _best(run, repeat),
+            }
+
+
+def _query_benchmarks(db: Session, calls: Sequence[int], repeat: int) -> Iterator[Dict[str, Any]]:
+    for inline_gd in (False, True):
+        manager = _inlining_manager(inline_gd)
+        manager.flush(db)
+        db.execute(text("SELECT _add_to_gd()"))
+        for count in calls:
+            query = text("SELECT sum(call_gd_helper(x)) FROM generate_series(1, :count) AS x")
+            yield {
+                "name": "query",
+                "params": {"calls": count, "inline_gd": inline_gd},
+                "seconds": _best(lambda: db.execute(query, {"count": count}).one(), repeat),
+            }
+    db.execute(text("DROP FUNCTION IF EXISTS call_gd_helper"))
+    _forget(db, "call_gd_helper")
+    db.commit()
+
+
+def _flush_benchmarks(
+    directory: Path, db: Session, registry_sizes: Sequence[int], repeat: int
+) -> Iterator[Dict[str, Any]]:
+    manager = plpy_man.PlpyMan()
+    for count in registry_sizes:
+        funcs = _functions(_write_module(directory, count, 5, _PREFIX), count, _PREFIX)
+
+        def register() -> None:
+            for func in funcs:
+                manager.plpy_func(func)
+
+        try:
+            for incremental in (False, True):
+                # The first incremental flush fills the catalog; the ones timed have nothing to do
+                register()
+                manager.flush(db, incremental=incremental)
+                yield {
+                    "name": "flush",
+                    "params": {"functions": count, "incremental": incremental},
+                    "seconds": _best(
+                        lambda: manager.flush(db, incremental=incremental), repeat, register
+                    ),
+                }
+            # The first diff generates the SQL; the ones timed reuse it
+            register()
+            manager.diff(db)
+            yield {
+                "name": "diff",
+                "params": {"functions": count},
+                "seconds": _best(lambda: manager.diff(db), repeat),
+            }
+            manager._clear()
+        finally:
+            _drop_functions(db, count)
+
+
+def _drop_functions(db: Session, count: int) -> None:
+    names = ", ".join(f"{_PREFIX}{i}" for i in range(count))
+    db.execute(text(f"DROP FUNCTION IF EXISTS {names}"))
+    _forget(db, f"{_PREFIX}%")
+    db.commit()
+
+
+def _forget(db: Session, pattern: str) -> None:
+    """ Removes catalog entries. The catalog only exists once an incremental flush created it """
+    if db.execute(text("SELECT to_regclass('plpy_man_catalog')")).scalar() is not None:
+        db.execute(
+            text("DELETE FROM plpy_man_catalog WHERE name LIKE :pattern"), {"pattern": pattern}
+        )
+
+
+def _connect() -> Optional[Session]:
+    from tests.conftest import database_url
+
+    try:
+        engine = create_engine(database_url(), future=True)
+        with engine.connect():
+            pass
+    except (OperationalError, ValueError) as err:
+        print(f"Skipping the flush benchmarks; the database is not available ({err}).")
+        return None
+    return Session(bind=engine)
+
+
+def _load_history(path: Path) -> Dict[str, Dict[str, Any]]:
+    """ The last recorded result of every benchmark """
+    last: Dict[str, Dict[str, Any]] = {}
+    if path.exists():
+        for line in path.read_text().splitlines():
+            if line.strip():
+                result = json.loads(line)
+                last[_key(result)] = result
+    return last
+
+
+def _key(result: Dict[str, Any]) -> str:
+    return f"{result['name']}{json.dumps(result['params'], sort_keys=True)}"
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--registry-sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--body-lines", type=int, nargs="+", default=[5, 50, 500])
+    parser.add_argument("--gd-sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--calls", type=int, nargs="+", default=[1000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-db", action="store_true", help="don't run the flush benchmarks")
+    parser.add_argument("--results", type=Path, default=_RESULTS, help="the history file")
+    parser.add_argument("--no-save", action="store_true", help="don't append to the history")
+    args = parser.parse_args(argv)
+
+    history = _load_history(args.results)
+    run = {
+        "date": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "python": platform.python_version(),
+    }
+    db = None if args.skip_db else _connect()
+    print(f"{'benchmark':<52} {'best (ms)':>11} {'previous (ms)':>14} {'change':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        benchmarks = [
+            _codegen_benchmarks(directory, args.registry_sizes, args.body_lines, args.repeat),
+            _gd_benchmarks(directory, args.gd_sizes, args.repeat),
+            _call_benchmarks(args.calls, args.repeat),
+        ]
+        if db is not None:
+            benchmarks.append(_flush_benchmarks(directory, db, args.registry_sizes, args.repeat))
+            benchmarks.append(_query_benchmarks(db, args.calls, args.repeat))
+        for results in benchmarks:
+            for result in results:
+                result.update(run)
+                previous = history.get(_key(result))
+                line = f"{_key(result):<52} {result['seconds'] * 1000:>11.2f}"
+                if previous:
+                    change = result["seconds"] / previous["seconds"] - 1
+                    line += f" {previous['seconds'] * 1000:>14.2f} {change:>+8.1%}"
+                print(line)
+                if not args.no_save:
+                    with args.results.open("a") as f:
+                        f.write(json.dumps(result) + "\n")
+    if db is not None:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
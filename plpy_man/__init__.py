@@ -4,37 +4,199 @@ To avoid repeating code (and accidentally ending up with different implementatio
 shared functions are added to the PlPython3u Global Dictionary.
 The functions are then callable from PlPython3u by using `GD["func_name"](arguments)`
 """
-__all__ = ["to_gd", "plpy_func", "flush", "manager", "mocks"]
+__all__ = [
+    "to_gd",
+    "to_package",
+    "to_gd_data",
+    "data_sizes",
+    "plpy_func",
+    "plpy_trigger",
+    "plpy_aggregate",
+    "get",
+    "unregister",
+    "flush",
+    "flush_async",
+    "flush_many",
+    "build",
+    "use_bundle",
+    "diff",
+    "manager",
+    "mocks",
+    "helpers",
+    "emulator",
+]
 
+import pickle
 from functools import wraps
-from typing import Any, Callable, Optional, Sequence, NoReturn
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Mapping, Optional, Sequence, Union
 
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
-from .manager import PlpyMan, Type_
-from . import mocks
+from .manager import DiffResult, FlushResult, PlpyMan, Type_
+from . import mocks, helpers, emulator
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
 
 
 _default_manager = PlpyMan()
 
 
 @wraps(PlpyMan.to_gd)
-def to_gd(obj: Any) -> None:
-    return _default_manager.to_gd(obj)
+def to_gd(obj: Any, dependencies: bool = False) -> None:
+    return _default_manager.to_gd(obj, dependencies)
+
+
+@wraps(PlpyMan.to_gd_data)
+def to_gd_data(
+    name: str, obj: Any, serializer: ModuleType = pickle, size_limit: int = 16 * 1024 * 1024
+) -> None:
+    return _default_manager.to_gd_data(name, obj, serializer, size_limit)
+
+
+@wraps(PlpyMan.data_sizes)
+def data_sizes() -> Dict[str, int]:
+    return _default_manager.data_sizes()
+
+
+@wraps(PlpyMan.to_package)
+def to_package(package: Union[ModuleType, str]) -> None:
+    return _default_manager.to_package(package)
 
 
 @wraps(PlpyMan.plpy_func)
 def plpy_func(
-    func: Callable[..., Any],
+    func: Optional[Callable[..., Any]] = None,
     argtypes: Optional[Sequence[Type_]] = None,
     rettype: Type_ = "",
-) -> Callable[..., NoReturn]:
-    return _default_manager.plpy_func(func, argtypes, rettype)
+    lazy_gd: bool = False,
+    volatility: Optional[str] = None,
+    parallel: Optional[str] = None,
+    strict: bool = False,
+    leakproof: bool = False,
+    cost: Optional[float] = None,
+    rows: Optional[float] = None,
+    config: Optional[Mapping[str, str]] = None,
+    batched: bool = False,
+    instrument: bool = False,
+    schema: Optional[str] = None,
+    overload: bool = False,
+    inline_gd: bool = False,
+) -> Callable[..., Any]:
+    return _default_manager.plpy_func(
+        func,
+        argtypes,
+        rettype,
+        lazy_gd,
+        volatility=volatility,
+        parallel=parallel,
+        strict=strict,
+        leakproof=leakproof,
+        cost=cost,
+        rows=rows,
+        config=config,
+        batched=batched,
+        instrument=instrument,
+        schema=schema,
+        overload=overload,
+        inline_gd=inline_gd,
+    )
+
+
+@wraps(PlpyMan.plpy_trigger)
+def plpy_trigger(
+    func: Optional[Callable[..., Any]] = None,
+    table: str = "",
+    events: Sequence[str] = ("INSERT",),
+    new_table: Optional[str] = None,
+    old_table: Optional[str] = None,
+    lazy_gd: bool = False,
+) -> Callable[..., Any]:
+    return _default_manager.plpy_trigger(func, table, events, new_table, old_table, lazy_gd)
+
+
+@wraps(PlpyMan.plpy_aggregate)
+def plpy_aggregate(
+    cls: Optional[type] = None,
+    parallel: Optional[str] = None,
+    lazy_gd: bool = False,
+) -> Any:
+    return _default_manager.plpy_aggregate(cls, parallel, lazy_gd)
+
+
+@wraps(PlpyMan.get)
+def get(
+    name: str, argtypes: Optional[Sequence[Type_]] = None, schema: Optional[str] = None
+) -> Callable[..., Any]:
+    return _default_manager.get(name, argtypes, schema)
+
+
+@wraps(PlpyMan.unregister)
+def unregister(
+    name: str, argtypes: Optional[Sequence[Type_]] = None, schema: Optional[str] = None
+) -> None:
+    return _default_manager.unregister(name, argtypes, schema)
 
 
 @wraps(PlpyMan.flush)
-def flush(db: Session) -> None:
-    return _default_manager.flush(db)
+def flush(
+    db: Session,
+    incremental: bool = False,
+    batched: bool = False,
+    chunk_size: int = 100,
+    precompile: bool = False,
+    lock: bool = False,
+    wait: bool = True,
+) -> None:
+    return _default_manager.flush(db, incremental, batched, chunk_size, precompile, lock, wait)
+
+
+@wraps(PlpyMan.flush_async)
+async def flush_async(
+    session: "Union[AsyncSession, AsyncConnection]",
+    incremental: bool = False,
+    batched: bool = False,
+    chunk_size: int = 100,
+    precompile: bool = False,
+    lock: bool = False,
+    wait: bool = True,
+) -> None:
+    return await _default_manager.flush_async(
+        session, incremental, batched, chunk_size, precompile, lock, wait
+    )
+
+
+@wraps(PlpyMan.flush_many)
+def flush_many(
+    targets: Sequence[Union[Session, Engine]],
+    max_workers: Optional[int] = None,
+    incremental: bool = False,
+    batched: bool = False,
+    chunk_size: int = 100,
+    precompile: bool = False,
+    lock: bool = False,
+    wait: bool = True,
+) -> List[FlushResult]:
+    return _default_manager.flush_many(
+        targets, max_workers, incremental, batched, chunk_size, precompile, lock, wait
+    )
+
+
+@wraps(PlpyMan.build)
+def build(path: str, precompile: bool = False) -> None:
+    return _default_manager.build(path, precompile)
+
+
+@wraps(PlpyMan.use_bundle)
+def use_bundle(path: Optional[str]) -> None:
+    return _default_manager.use_bundle(path)
+
+
+@wraps(PlpyMan.diff)
+def diff(db: Session, precompile: bool = False) -> DiffResult:
+    return _default_manager.diff(db, precompile)
 
 
 __cake__ = "\u2728 \U0001f9b8\u200d\u2642\ufe0f \u2728"
@@ -0,0 +1,51 @@
+"""
+Command line interface
+
+    python -m plpy_man build myapp.db_functions -o plpy_man_bundle.json
+
+imports the modules (which register their objects as they are imported) and writes the SQL
+flush would send to a bundle. At runtime, `plpy_man.use_bundle("plpy_man_bundle.json")`
+makes flush send the bundled SQL instead of generating it.
+"""
+import argparse
+import importlib
+from typing import List, Optional
+
+from . import PlpyMan, _default_manager
+
+
+def _get_manager(name: Optional[str]) -> PlpyMan:
+    """ The manager at module:attribute, or the default manager plpy_man's functions use """
+    if name is None:
+        return _default_manager
+    module, _, attribute = name.partition(":")
+    manager = getattr(importlib.import_module(module), attribute or "manager")
+    if not isinstance(manager, PlpyMan):
+        raise SystemExit(f"{name} is not a PlpyMan")
+    return manager
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m plpy_man", description=__doc__.split("\n")[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="write the SQL of registered objects to a bundle")
+    build.add_argument("modules", nargs="+", help="modules that register objects when imported")
+    build.add_argument("-o", "--output", default="plpy_man_bundle.json")
+    build.add_argument(
+        "--manager",
+        help="the PlpyMan objects are registered with, as module:attribute "
+        "(default: the manager used by plpy_man.plpy_func and friends)",
+    )
+    build.add_argument(
+        "--precompile", action="store_true", help="the precompile option flush is called with"
+    )
+    args = parser.parse_args(argv)
+
+    for module in args.modules:
+        importlib.import_module(module)
+    _get_manager(args.manager).build(args.output, args.precompile)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
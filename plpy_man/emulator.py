@@ -0,0 +1,379 @@
+"""
+Runs the bodies of PlPython functions in this process, the way PlPython would run them.
+Unlike the mocks, the emulator works: the GD and SD are real dictionaries and plpy queries
+a database through a SQLAlchemy session, so database functions can be run, debugged and profiled
+(e.g. with cProfile) without installing them into Postgres.
+
+    emulator = Emulator(db)
+    emulator.to_gd(py_average)
+    cProfile.run("emulator.call(average_wage)")
+"""
+__all__ = ["Emulator", "EmulatedPlpy", "EmulatedResult", "EmulatedPlan", "EmulatedCursor"]
+
+import ast
+import contextlib
+import inspect
+import itertools
+import json
+import logging
+import re
+from types import CodeType
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence, Union
+
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import text
+
+from .manager import _dedent_definition, _prep_gd_script
+
+logger = logging.getLogger(__name__)
+
+# https://www.postgresql.org/docs/13/spi-spi-execute.html
+_SPI_STATUSES = {
+    "SELECT": 5,
+    "INSERT": 7,
+    "DELETE": 8,
+    "UPDATE": 9,
+}
+_SPI_OK_UTILITY = 4
+
+
+class EmulatedResult(List[Dict[str, Any]]):
+    """ The rows (as dictionaries) returned by plpy.execute, like PlPython's PLyResult """
+
+    def __init__(
+        self,
+        rows: Sequence[Dict[str, Any]] = (),
+        nrows: int = 0,
+        status: int = _SPI_OK_UTILITY,
+        description: Optional[Sequence[Sequence[Any]]] = None,
+    ) -> None:
+        super().__init__(rows)
+        self._nrows = nrows
+        self._status = status
+        self._description = description
+
+    def nrows(self) -> int:
+        return self._nrows
+
+    def status(self) -> int:
+        return self._status
+
+    def colnames(self) -> List[str]:
+        return [column[0] for column in self._get_description()]
+
+    def coltypes(self) -> List[Any]:
+        # The driver's type codes: with psycopg2, these are the type OIDs PlPython returns
+        return [column[1] for column in self._get_description()]
+
+    def _get_description(self) -> Sequence[Sequence[Any]]:
+        if self._description is None:
+            raise EmulatedPlpy.Error("command did not produce a result set")
+        return self._description
+
+
+class EmulatedPlan:
+    """ A query prepared with plpy.prepare """
+
+    def __init__(self, plpy: "EmulatedPlpy", query: str, argtypes: Sequence[str] = ()) -> None:
+        self.plpy = plpy
+        self.query = query
+        self.argtypes = list(argtypes)
+
+    def execute(self, args: Sequence[Any] = (), limit: int = 0) -> EmulatedResult:
+        return self.plpy.execute(self, args, limit)
+
+    def cursor(self, args: Sequence[Any] = ()) -> "EmulatedCursor":
+        return self.plpy.cursor(self, args)
+
+    def status(self) -> bool:
+        return True
+
+
+class EmulatedCursor:
+    """ The cursor returned by plpy.cursor. Rows are read from the database as they're fetched """
+
+    def __init__(self, rows: Iterator[Dict[str, Any]]) -> None:
+        self._rows: Optional[Iterator[Dict[str, Any]]] = rows
+
+    def fetch(self, n: int) -> EmulatedResult:
+        if self._rows is None:
+            raise EmulatedPlpy.Error("iterating a closed cursor")
+        rows = list(itertools.islice(self._rows, n))
+        return EmulatedResult(rows, len(rows), _SPI_STATUSES["SELECT"])
+
+    def close(self) -> None:
+        self._rows = None
+
+    def __iter__(self) -> "EmulatedCursor":
+        return self
+
+    def __next__(self) -> Dict[str, Any]:
+        if self._rows is None:
+            raise EmulatedPlpy.Error("iterating a closed cursor")
+        return next(self._rows)
+
+
+class EmulatedPlpy:
+    """ plpy, with queries sent to a database through a SQLAlchemy session """
+
+    class Error(Exception):
+        ...
+
+    class Fatal(Exception):
+        ...
+
+    class SPIError(Exception):
+        ...
+
+    def __init__(self, db: Optional[Session] = None) -> None:
+        self.db = db
+
+    # https://www.postgresql.org/docs/13/plpython-database.html
+    def execute(
+        self, query: Union[EmulatedPlan, str], args: Any = (), limit: int = 0
+    ) -> EmulatedResult:
+        if isinstance(query, str):
+            # plpy.execute(query [, limit])
+            query, args, limit = EmulatedPlan(self, query), (), args or limit
+        result = self._execute(query, args)
+        if not result.returns_rows:
+            keyword = query.query.split(None, 1)[0].upper() if query.query.strip() else ""
+            return EmulatedResult(
+                nrows=max(result.rowcount, 0), status=_SPI_STATUSES.get(keyword, _SPI_OK_UTILITY)
+            )
+        description = result.cursor.description
+        mappings = result.mappings()
+        rows = [dict(row) for row in (mappings.fetchmany(limit) if limit else mappings.all())]
+        result.close()
+        return EmulatedResult(rows, len(rows), _SPI_STATUSES["SELECT"], description)
+
+    def prepare(self, query: str, argtypes: Sequence[str] = ()) -> EmulatedPlan:
+        return EmulatedPlan(self, query, argtypes)
+
+    def cursor(self, query: Union[EmulatedPlan, str], args: Sequence[Any] = ()) -> EmulatedCursor:
+        if isinstance(query, str):
+            query = EmulatedPlan(self, query)
+        result = self._execute(query, args, stream=True)
+        return EmulatedCursor(dict(row) for row in result.mappings())
+
+    def commit(self) -> None:
+        self._get_db().commit()
+
+    def rollback(self) -> None:
+        self._get_db().rollback()
+
+    @contextlib.contextmanager
+    def subtransaction(self) -> Iterator[None]:
+        with self._get_db().begin_nested():
+            yield
+
+    def _get_db(self) -> Session:
+        if self.db is None:
+            raise RuntimeError("The emulator was not given a database session to query.")
+        return self.db
+
+    def _execute(self, plan: EmulatedPlan, args: Sequence[Any], stream: bool = False) -> Any:
+        if len(args) != len(plan.argtypes):
+            raise TypeError(
+                f"Expected sequence of {len(plan.argtypes)} arguments, got {len(args)}: {args}"
+            )
+        statement = text(_bind_parameters(plan.query, plan.argtypes))
+        if stream:
+            statement = statement.execution_options(stream_results=True)
+        params = {f"p{i}": arg for i, arg in enumerate(args, start=1)}
+        try:
+            return self._get_db().execute(statement, params)
+        except DBAPIError as err:
+            raise self.SPIError(str(err.orig)) from err
+
+    # https://www.postgresql.org/docs/13/plpython-util.html
+    def debug(self, msg: Any, *args: Any, **kwargs: Any) -> None:
+        logger.debug(_message(msg, args))
+
+    def log(self, msg: Any, *args: Any, **kwargs: Any) -> None:
+        logger.info(_message(msg, args))
+
+    def info(self, msg: Any, *args: Any, **kwargs: Any) -> None:
+        logger.info(_message(msg, args))
+
+    def notice(self, msg: Any, *args: Any, **kwargs: Any) -> None:
+        logger.info(_message(msg, args))
+
+    def warning(self, msg: Any, *args: Any, **kwargs: Any) -> None:
+        logger.warning(_message(msg, args))
+
+    def error(self, msg: Any, *args: Any, **kwargs: Any) -> None:
+        raise self.Error(_message(msg, args))
+
+    def fatal(self, msg: Any, *args: Any, **kwargs: Any) -> None:
+        raise self.Fatal(_message(msg, args))
+
+    @staticmethod
+    def quote_literal(string: str) -> str:
+        quoted = "'" + string.replace("'", "''").replace("\\", "\\\\") + "'"
+        return "E" + quoted if "\\" in string else quoted
+
+    @staticmethod
+    def quote_nullable(string: Optional[str]) -> str:
+        return "NULL" if string is None else EmulatedPlpy.quote_literal(string)
+
+    @staticmethod
+    def quote_ident(string: str) -> str:
+        if re.fullmatch(r"[a-z_][a-z0-9_$]*", string):
+            return string
+        return '"' + string.replace('"', '""') + '"'
+
+
+def _message(msg: Any, args: Sequence[Any]) -> str:
+    """ PlPython's log functions join their arguments like print """
+    return " ".join(str(arg) for arg in (msg, *args))
+
+
+def _bind_parameters(query: str, argtypes: Sequence[str]) -> str:
+    """ Rewrites a plpy query's $1, $2, ... as SQLAlchemy bind parameters :p1, :p2, ... """
+    # Colons already in the query (e.g. casts) must not be parsed as bind parameters
+    query = query.replace(":", "\\:")
+
+    def bind(match: "re.Match[str]") -> str:
+        i = int(match.group(1))
+        if i <= len(argtypes):
+            return f"CAST(:p{i} AS {argtypes[i - 1]})"
+        return f":p{i}"
+
+    return re.sub(r"\$(\d+)", bind, query)
+
+
+class Emulator:
+    """
+    Calls PlPython functions in this process.
+
+    As in PlPython, every function gets its own Static Dictionary (SD) and globals,
+    the functions' arguments are set as globals and every function shares the emulator's GD.
+    The code is compiled with the function's own file name and line numbers,
+    so tracebacks and profilers point at the original source.
+    """
+
+    def __init__(self, db: Optional[Session] = None) -> None:
+        self.db = db
+        self.GD: Dict[Any, Any] = {}
+        self.plpy = EmulatedPlpy(db)
+        self._functions: Dict[Callable[..., Any], _EmulatedFunction] = {}
+
+    def to_gd(self, *objs: Any) -> None:
+        """ Copies objects to the GD, running the same script flush installs in _add_to_gd """
+        script = _prep_gd_script(objs)
+        namespace = {"__name__": "_add_to_gd", "GD": self.GD, "SD": {}, "plpy": self.plpy}
+        exec(compile(script, "<_add_to_gd>", "exec"), namespace)
+
+    def call(
+        self,
+        func: Callable[..., Any],
+        *args: Any,
+        TD: Optional[Mapping[str, Any]] = None,
+        transition_tables: Optional[Mapping[str, Sequence[Mapping[str, Any]]]] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        Runs a function's body (the function may be the one plpy_func returned)
+        with the given arguments, or, for trigger functions, the trigger data TD.
+
+        Statement triggers query the rows the statement changed from their transition tables.
+        `transition_tables` maps the tables' names (the trigger's new_table and old_table)
+        to those rows: they're created as temporary tables with the columns of the TD's table
+        and dropped after the call.
+        """
+        func = inspect.unwrap(func)
+        function = self._functions.get(func)
+        if function is None:
+            function = self._functions[func] = _EmulatedFunction(func, self)
+        with self._transition_tables(transition_tables or {}, TD or {}):
+            return function(args, kwargs, TD)
+
+    @contextlib.contextmanager
+    def _transition_tables(
+        self, tables: Mapping[str, Sequence[Mapping[str, Any]]], TD: Mapping[str, Any]
+    ) -> Iterator[None]:
+        if not tables:
+            yield
+            return
+        if not TD.get("table_name"):
+            raise ValueError(
+                'Transition tables have the columns of the trigger\'s table: set TD["table_name"].'
+            )
+        quote_ident = self.plpy.quote_ident
+        table = quote_ident(TD["table_name"])
+        if TD.get("table_schema"):
+            table = f"{quote_ident(TD['table_schema'])}.{table}"
+        db = self.plpy._get_db()
+        created = []
+        try:
+            for name, rows in tables.items():
+                db.execute(text(f"CREATE TEMPORARY TABLE {quote_ident(name)} (LIKE {table})"))
+                created.append(f"pg_temp.{quote_ident(name)}")
+                db.execute(
+                    text(
+                        f"INSERT INTO {created[-1]} SELECT * "
+                        f"FROM json_populate_recordset(NULL::{created[-1]}, CAST(:rows AS json))"
+                    ),
+                    {"rows": json.dumps([dict(row) for row in rows], default=str)},
+                )
+            yield
+        finally:
+            # If the call failed in the database, the tables go with the aborted transaction
+            with contextlib.suppress(SQLAlchemyError):
+                for temporary_table in created:
+                    db.execute(text(f"DROP TABLE {temporary_table}"))
+
+
+class _EmulatedFunction:
+    """ A function's compiled body and the globals it runs with """
+
+    def __init__(self, func: Callable[..., Any], emulator: Emulator) -> None:
+        self.signature = inspect.signature(func)
+        self.code = _compile_body(func)
+        self.globals: Dict[str, Any] = {
+            "__name__": func.__name__,
+            "GD": emulator.GD,
+            "SD": {},
+            "plpy": emulator.plpy,
+        }
+
+    def __call__(
+        self, args: Sequence[Any], kwargs: Mapping[str, Any], TD: Optional[Mapping[str, Any]]
+    ) -> Any:
+        bound = self.signature.bind(*args, **kwargs)
+        self.globals.update(bound.arguments)
+        if TD is not None:
+            self.globals["TD"] = dict(TD)
+        namespace: Dict[str, Any] = {}
+        exec(self.code, self.globals, namespace)
+        (body,) = namespace.values()
+        return body()
+
+
+def _compile_body(func: Callable[..., Any]) -> CodeType:
+    """
+    Compiles a function's body as PlPython does: inside a function without parameters.
+    The function keeps its name, so profilers report it under the name it was written with.
+    The original source is compiled, so every line keeps its line number.
+    """
+    lines, start = inspect.getsourcelines(func)
+    tree = ast.parse(_dedent_definition(lines))
+    node = tree.body[0]
+    if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        raise TypeError(f"{func.__name__} is not defined with def")
+    node.decorator_list = []
+    node.args = ast.arguments(
+        posonlyargs=[],
+        args=[],
+        vararg=None,
+        kwonlyargs=[],
+        kw_defaults=[],
+        kwarg=None,
+        defaults=[],
+    )
+    node.returns = None
+    ast.increment_lineno(tree, start - 1)
+    filename = inspect.getsourcefile(func) or f"<{func.__name__}>"
+    return compile(tree, filename, "exec")
@@ -0,0 +1,32 @@
+"""
+Functions meant to run inside PlPython.
+Add them to the Global Dictionary like any other shared code: `plpy_man.to_gd(cached_execute)`.
+"""
+__all__ = ["cached_execute"]
+
+from typing import Any, Dict, Sequence
+
+from .mocks import PLyResult, plpy
+
+
+# The annotations are strings: they're evaluated when _add_to_gd defines the function,
+#  where typing and the mocks aren't imported.
+def cached_execute(
+    SD: "Dict",
+    query: str,
+    types: "Sequence[str]" = (),
+    args: "Sequence[Any]" = (),
+    limit: int = 0,
+) -> "PLyResult":
+    """
+    Executes a query with a plan that is only prepared the first time the query is run.
+
+    Plans are cached in the calling function's Static Dictionary, so each function prepares
+    a query once per backend instead of parsing and planning it on every call:
+    `rows = GD["cached_execute"](SD, "SELECT name FROM users WHERE id = $1", ["int"], [user_id])`
+    """
+    key = ("plpy_man.cached_execute", query, tuple(types))
+    plan = SD.get(key)
+    if plan is None:
+        plan = SD[key] = plpy.prepare(query, list(types))
+    return plan.execute(list(args), limit)
@@ -1,13 +1,51 @@
 import ast
+import asyncio
+import base64
+import collections.abc
 import datetime as dt
 import decimal
+import hashlib
+import importlib.util
 import inspect
+import json
+import marshal
+import os
+import pickle
+import re
+import symtable
+import sys
+import sysconfig
 import textwrap
-from typing import Sequence, Any, List, Callable, NoReturn, Union, Tuple, Dict, TypedDict, Optional
+import time
+import tokenize
+import typing
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType
+from typing import (
+    TYPE_CHECKING,
+    Sequence,
+    Any,
+    List,
+    Callable,
+    NoReturn,
+    Union,
+    Tuple,
+    Dict,
+    TypedDict,
+    Optional,
+    Generator,
+    Iterator,
+    Mapping,
+    Set,
+    Container,
+    NamedTuple,
+)
 
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 from sqlalchemy.sql.type_api import TypeEngine
-from sqlalchemy.sql.expression import text
+from sqlalchemy.sql.expression import text, TextClause
 from sqlalchemy.sql.sqltypes import (
     NULLTYPE,
     BOOLEANTYPE,
@@ -22,6 +60,9 @@ from sqlalchemy.sql.sqltypes import (
     LargeBinary,
 )
 
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
 
 Type_ = Union[TypeEngine, str, Any]
 
@@ -30,6 +71,64 @@ class _ToSqlArgs(TypedDict):
     func: Callable[..., Any]
     argtypes: Optional[Sequence[Type_]]
     rettype: Type_
+    lazy_gd: bool
+    volatility: Optional[str]
+    parallel: Optional[str]
+    strict: bool
+    leakproof: bool
+    cost: Optional[float]
+    rows: Optional[float]
+    config: Optional[Mapping[str, str]]
+    batched: bool
+    instrument: bool
+    schema: Optional[str]
+    inline_gd: bool
+
+
+# Registered functions are keyed by their (schema, name) and then by their argument types
+_FuncName = Tuple[Optional[str], str]
+_Signature = Tuple[str, ...]
+
+
+class _TriggerArgs(TypedDict):
+    func: Callable[..., Any]
+    table: str
+    events: Sequence[str]
+    new_table: Optional[str]
+    old_table: Optional[str]
+    lazy_gd: bool
+
+
+class _GDArgs(TypedDict):
+    obj: Any
+    dependencies: bool
+
+
+class _GDDataArgs(TypedDict):
+    obj: Any
+    serializer: ModuleType
+    size_limit: int
+
+
+class _Expected(NamedTuple):
+    """ The functions PlpyMan.diff expects, and what they were generated from """
+
+    key: Tuple[bool, Dict[str, int]]
+    registrations: List[object]
+    functions: List["_DefinedFunction"]
+
+
+class _AggregateArgs(TypedDict):
+    cls: type
+    parallel: Optional[str]
+    lazy_gd: bool
+
+
+# The options _generate passes to every function, trigger and aggregate
+class _GDOptions(TypedDict):
+    gd_version: str
+    packages: Sequence[str]
+    data: Mapping[str, str]
 
 
 # Keep in mind: "Reflection is never clever." https://go-proverbs.github.io/
@@ -37,72 +136,1046 @@ class _ToSqlArgs(TypedDict):
 #  to ensure the code on the server and in the database remain identical.
 class PlpyMan:
     def __init__(self) -> None:
-        self._gd: List[Any] = []
-        self._funcs: List[_ToSqlArgs] = []
+        # Registered objects, keyed by name. Registering a name again replaces its registration.
+        self._gd: Dict[str, _GDArgs] = {}
+        self._funcs: Dict[_FuncName, Dict[_Signature, _ToSqlArgs]] = {}
+        self._triggers: Dict[str, _TriggerArgs] = {}
+        self._aggregates: Dict[str, _AggregateArgs] = {}
+        self._packages: Dict[str, ModuleType] = {}
+        self._data: Dict[str, _GDDataArgs] = {}
+        # The serialized objects of to_gd_data, with the registration they were serialized for
+        self._serialized: Dict[str, Tuple[_GDDataArgs, bytes]] = {}
+        self._bundle: Optional[str] = None
+        # The functions diff last expected, and the registry and sources they were generated from
+        self._expected: Optional[_Expected] = None
+
+    def to_gd(self, obj: Any, dependencies: bool = False) -> None:
+        """
+        Registers an object to have its source copied to the PlPython Global Dictionary
+
+        With `dependencies`, the module-level names the object uses are copied along with it:
+        the functions, classes and assignments of the application that define them
+        (and, recursively, the names those use) and the imports of modules that come with Python
+        or are installed packages, which must also be installed for the database's Python.
+        Nothing else from the object's module is copied.
+        """
+        self._gd[obj.__name__] = {"obj": obj, "dependencies": dependencies}
+
+    def to_package(self, package: Union[ModuleType, str]) -> None:
+        """
+        Registers a module or package (with all of its modules) to be uploaded to the database,
+        where PlPython can import it with the import statement.
 
-    def to_gd(self, obj: Any) -> None:
-        """ Registers an object to have its source copied to the PlPython Global Dictionary """
-        self._gd.append(obj)
+        Flushing stores the source of the modules in the plpy_man_modules table
+        and functions that import them install a finder (in sys.meta_path) that imports modules
+        from the table. Each backend only loads the modules it imports, when it imports them.
+        Only the package's Python source files are uploaded.
+        Like the GD, a backend keeps the modules it imported: changes are seen by new sessions.
+        """
+        if isinstance(package, str):
+            package = importlib.import_module(package)
+        _package_modules(package)  # Packages that can't be uploaded are reported when registered
+        self._packages[package.__name__] = package
+
+    def to_gd_data(
+        self,
+        name: str,
+        obj: Any,
+        serializer: ModuleType = pickle,
+        size_limit: int = 16 * 1024 * 1024,
+    ) -> None:
+        """
+        Registers an object to be serialized into the database and loaded into the GD as `name`
+
+        Unlike to_gd, which copies source, the object itself is stored: it is serialized
+        with `serializer` (a module with dumps and loads, such as pickle, json or marshal,
+        that the database's Python can also import) into the plpy_man_data table.
+        A function (or GD object) that looks it up as `GD["name"]` loads it the first time
+        it runs in a backend, and again after a flush changes it.
+        Objects of the application's own classes can be unpickled if their modules can be
+        imported in the database (see to_package).
+
+        The object is serialized once per registration, the first time it's needed
+        (by data_sizes, diff, build or flush). Changes made to it after that are not flushed
+        unless it is registered again.
+        Every backend that uses the object holds its own copy of it. Flushing warns when the
+        serialized object is larger than `size_limit` bytes; see data_sizes.
+        """
+        if not name.isidentifier():
+            raise ValueError(f"{name!r} is not a valid name for GD data.")
+        if not (hasattr(serializer, "dumps") and hasattr(serializer, "loads")):
+            raise TypeError(f"{serializer!r} can not serialize GD data: it needs dumps and loads.")
+        self._data[name] = {"obj": obj, "serializer": serializer, "size_limit": size_limit}
+
+    def data_sizes(self) -> Dict[str, int]:
+        """ The serialized size (in bytes) of every object registered with to_gd_data """
+        return {name: len(data) for name, data in self._serialize_data().items()}
 
     def plpy_func(
         self,
-        func: Callable[..., Any],
+        func: Optional[Callable[..., Any]] = None,
         argtypes: Optional[Sequence[Type_]] = None,
         rettype: Type_ = "",
-    ) -> Callable[..., NoReturn]:
+        lazy_gd: bool = False,
+        volatility: Optional[str] = None,
+        parallel: Optional[str] = None,
+        strict: bool = False,
+        leakproof: bool = False,
+        cost: Optional[float] = None,
+        rows: Optional[float] = None,
+        config: Optional[Mapping[str, str]] = None,
+        batched: bool = False,
+        instrument: bool = False,
+        schema: Optional[str] = None,
+        overload: bool = False,
+        inline_gd: bool = False,
+    ) -> Callable[..., Any]:
         """
         Decorator that registers a PlPython Function
 
         Functions wrapped by plpy_func do not execute on the web server.
         Instead, the function can be called from the database as a PlPython function.
+
+        Options can be passed by calling the decorator: `@plpy_func(lazy_gd=True)`.
+        With `lazy_gd`, the function loads the GD (see to_gd) the first time it runs on a backend
+        that has not loaded the current version of it yet.
+
+        The remaining options are emitted as the function's attributes:
+        `volatility` is IMMUTABLE, STABLE or VOLATILE, `parallel` is SAFE, RESTRICTED or UNSAFE,
+        `cost` and `rows` are the planner's estimates (`rows` only for functions returning a set)
+        and `config` maps configuration parameters to the values (written verbatim) they are SET
+        to while the function runs.
+
+        With `batched`, a `<name>_batch` variant is also created. It takes arrays of the function's
+        arguments and returns the array of its results, amortizing the cost of a call over many
+        rows.
+
+        With `instrument`, the function records how many times it was called, the total and
+        maximum time its calls took and the time spent in plpy.execute, plpy.prepare and
+        plpy.cursor. The times of a set-returning function include producing its rows,
+        which PlPython may iterate after the function returned.
+        The statistics are kept per backend and can be queried with
+        `SELECT * FROM plpy_man_stats()` (times are in milliseconds).
+        Functions that are not instrumented run exactly as written.
+
+        The function is created in `schema`, if given, and registered under its schema and name:
+        registering a function with the same name again (e.g. when its module is reloaded)
+        replaces the earlier registration, so it is only flushed once.
+        With `overload`, functions of the same name with different argument types are kept
+        side by side and flushed as overloads of each other.
+
+        With `inline_gd`, the function's `GD["name"]` lookups of objects registered with to_gd
+        are replaced by the objects themselves: their source (and, if they were registered with
+        `dependencies`, that of their dependencies) is copied into the function and run
+        the first time the function is called in a backend.
+        The function then runs without the GD loaded and without looking objects up in it.
         """
-        self._funcs.append({"func": func, "argtypes": argtypes, "rettype": rettype})
-
-        def wrapper(*args: Any, **kwargs: Any) -> NoReturn:
-            raise TypeError(
-                f"{func.__name__} was registered as a plpy_func. "
-                f"This means that only the database can run this function.\n\n"
-                f"Were you trying to write a function that both "
-                f"this script AND Plpython could accesses?\n"
-                f"Instead of decorating {func.__name__} with plpy_func, "
-                f"use something like `plpy_man.to_gd({func.__name__})`. "
-                f"Then you can access this function in the GD of plpy functions while "
-                f"still being able to call this function normally."
+        _check_attributes(volatility, parallel)
+        args: _ToSqlArgs = {
+            "func": func,  # type: ignore
+            "argtypes": argtypes,
+            "rettype": rettype,
+            "lazy_gd": lazy_gd,
+            "volatility": volatility,
+            "parallel": parallel,
+            "strict": strict,
+            "leakproof": leakproof,
+            "cost": cost,
+            "rows": rows,
+            "config": config,
+            "batched": batched,
+            "instrument": instrument,
+            "schema": schema,
+            "inline_gd": inline_gd,
+        }
+        if func is None:
+            return lambda f: self._plpy_func({**args, "func": f}, overload)
+        return self._plpy_func(args, overload)
+
+    def _plpy_func(self, args: _ToSqlArgs, overload: bool = False) -> Callable[..., NoReturn]:
+        # Registering the function plpy_func returned registers the original function
+        func = args["func"] = inspect.unwrap(args["func"])
+        if args["schema"] is None:
+            _check_name(func.__name__)
+        if args["rows"] is not None and not _returns_set(func, args["rettype"]):
+            raise ValueError(
+                f"{func.__name__} can not estimate rows because it doesn't return a set."
             )
+        key = (args["schema"], func.__name__)
+        if overload:
+            self._funcs.setdefault(key, {})[_registered_signature(args)] = args
+        else:
+            self._funcs[key] = {_registered_signature(args): args}
+        return _database_only(func)
+
+    def get(
+        self,
+        name: str,
+        argtypes: Optional[Sequence[Type_]] = None,
+        schema: Optional[str] = None,
+    ) -> Callable[..., Any]:
+        """
+        The function registered by plpy_func as `name` (in `schema`).
+        The argument types (as registered, or as the Python types they were annotated with)
+        pick one of a function's overloads.
+        """
+        overloads = self._funcs.get((schema, name), {})
+        if argtypes is not None:
+            args = overloads.get(_signature(argtypes))
+        elif len(overloads) > 1:
+            raise KeyError(f"{name} is overloaded. Pass the argtypes of the overload to get.")
+        else:
+            args = next(iter(overloads.values()), None)
+        if args is None:
+            raise KeyError(f"No function {name} with the argument types {argtypes} is registered.")
+        return args["func"]
+
+    def unregister(
+        self,
+        name: str,
+        argtypes: Optional[Sequence[Type_]] = None,
+        schema: Optional[str] = None,
+    ) -> None:
+        """
+        Removes the function registered by plpy_func as `name` (in `schema`),
+        or only its overload taking `argtypes`, from the registry.
+        Functions that were already flushed are not dropped from the database.
+        """
+        overloads = self._funcs.get((schema, name), {})
+        signatures = list(overloads) if argtypes is None else [_signature(argtypes)]
+        if not overloads or any(signature not in overloads for signature in signatures):
+            raise KeyError(f"No function {name} with the argument types {argtypes} is registered.")
+        for signature in signatures:
+            del overloads[signature]
+        if not overloads:
+            del self._funcs[(schema, name)]
+
+    def plpy_trigger(
+        self,
+        func: Optional[Callable[..., Any]] = None,
+        table: str = "",
+        events: Sequence[str] = ("INSERT",),
+        new_table: Optional[str] = None,
+        old_table: Optional[str] = None,
+        lazy_gd: bool = False,
+    ) -> Callable[..., Any]:
+        """
+        Decorator that registers a statement-level PlPython trigger function on `table`
+
+        The function (which takes no arguments) is created as a `RETURNS trigger` function,
+        along with an AFTER ... FOR EACH STATEMENT trigger of the same name that fires on `events`
+        (any of INSERT, UPDATE, DELETE and TRUNCATE).
+        The trigger is called once per statement rather than once per row.
+        The rows the statement changed are in the transition tables: set `new_table` and/or
+        `old_table` to name them and query them with plpy, e.g.
+        `plpy.execute("INSERT INTO audit SELECT * FROM new_rows")`.
+        Postgres only allows transition tables on triggers with a single event.
+        Emulator.call can create them to run the trigger outside of a trigger.
+        """
+        args: _TriggerArgs = {
+            "func": func,  # type: ignore
+            "table": table,
+            "events": events,
+            "new_table": new_table,
+            "old_table": old_table,
+            "lazy_gd": lazy_gd,
+        }
+        _check_trigger(args)
+        if func is None:
+            return lambda f: self._plpy_trigger({**args, "func": f})
+        return self._plpy_trigger(args)
 
-        return wrapper
+    def _plpy_trigger(self, args: _TriggerArgs) -> Callable[..., NoReturn]:
+        _check_name(args["func"].__name__)
+        self._triggers[args["func"].__name__] = args
+        return _database_only(args["func"], "plpy_trigger")
 
-    def flush(self, db: Session) -> None:
+    def plpy_aggregate(
+        self,
+        cls: Optional[type] = None,
+        parallel: Optional[str] = None,
+        lazy_gd: bool = False,
+    ) -> Any:
+        """
+        Class decorator that registers a PlPython aggregate
+
+        The class holds the aggregate's support functions as (static) methods, which become
+        PlPython functions named `<class name>_<method name>`:
+        `step(state, *args)` returns the new state after a row; its first argument is NULL (None)
+        until the first row has been seen unless the class sets `initcond`
+        (the initial state, written as a Postgresql literal).
+        `combine(state, other)` (optional) merges two partial states.
+        `final(state)` (optional) returns the aggregate's result; without it, the state is
+        returned.
+        The aggregate's argument types and state type come from `step`'s type annotations.
+
+        With a `combine` method and `parallel="SAFE"`, Postgres can compute the aggregate
+        with a parallel partial aggregation.
+
+        The class itself is returned unchanged, so its methods can still be tested in Python.
+        """
+        _check_attributes(None, parallel)
+        if cls is None:
+            return lambda c: self.plpy_aggregate(c, parallel, lazy_gd)
+        _check_name(cls.__name__)
+        self._aggregates[cls.__name__] = {"cls": cls, "parallel": parallel, "lazy_gd": lazy_gd}
+        return cls
+
+    def flush(
+        self,
+        db: Session,
+        incremental: bool = False,
+        batched: bool = False,
+        chunk_size: int = 100,
+        precompile: bool = False,
+        lock: bool = False,
+        wait: bool = True,
+    ) -> None:
         """Flush registered objects
         (functions decorated by plpy_func and objects supplied to to_gd) to the database.
+
+        When `incremental` is set, a content hash of every generated statement is stored in the
+        manager's catalog table. Objects whose hash has not changed since the last flush are
+        skipped.
+
+        When `batched` is set, the function definitions are sent as multi-statement strings of
+        up to `chunk_size` statements each instead of one round trip per function.
+        Either way, the flush runs in a single transaction that is rolled back if any statement
+        fails.
+
+        When `precompile` is set, the GD script is compiled here and its marshalled code object is
+        stored in the database. Backends running the same Python version execute the code object
+        instead of parsing the script; other backends fall back to the source.
+
+        When `lock` is set, flushes are serialized with a Postgres advisory lock and a hash of
+        everything flushed is stored as the registry's version. Sessions that find the version
+        up to date return after a single query, without taking the lock. Otherwise only one of
+        many workers starting at once writes the DDL; the others wait for the lock and find the
+        version up to date or, if `wait` is not set, return immediately.
+        """
+        _check_chunk_size(chunk_size)
+        statements = self._compile(precompile)
+        steps = _flush_steps(statements, incremental, chunk_size if batched else 1, lock, wait)
+        _execute(db, steps)
+        self._clear()
+
+    def flush_many(
+        self,
+        targets: Sequence[Union[Session, Engine]],
+        max_workers: Optional[int] = None,
+        incremental: bool = False,
+        batched: bool = False,
+        chunk_size: int = 100,
+        precompile: bool = False,
+        lock: bool = False,
+        wait: bool = True,
+    ) -> List["FlushResult"]:
+        """Flush registered objects to several databases (sessions or engines) concurrently.
+
+        The SQL is generated once and sent to every target from a pool of `max_workers` threads.
+        A failing target does not stop the others: the result of every target,
+        including the error it raised (if any) and how long it took, is returned in order.
+        The registry is only cleared if every target succeeded. Options are the same as flush's.
+        """
+        _check_chunk_size(chunk_size)
+        statements = self._compile(precompile)
+
+        def flush_target(target: Union[Session, Engine]) -> FlushResult:
+            start = time.perf_counter()
+            db = Session(bind=target) if isinstance(target, Engine) else target
+            error = None
+            try:
+                steps = _flush_steps(
+                    statements, incremental, chunk_size if batched else 1, lock, wait
+                )
+                _execute(db, steps)
+            except Exception as err:
+                error = err
+            finally:
+                if db is not target:
+                    db.close()
+            return {"target": target, "error": error, "seconds": time.perf_counter() - start}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(flush_target, targets))
+        if all(result["error"] is None for result in results):
+            self._clear()
+        return results
+
+    async def flush_async(
+        self,
+        session: "Union[AsyncSession, AsyncConnection]",
+        incremental: bool = False,
+        batched: bool = False,
+        chunk_size: int = 100,
+        precompile: bool = False,
+        lock: bool = False,
+        wait: bool = True,
+    ) -> None:
+        """flush for SQLAlchemy's asyncio extension (an AsyncSession or AsyncConnection).
+
+        The SQL is generated in the event loop's default executor and the statements are awaited
+        one after another, so neither blocks the event loop. Options are the same as flush's,
+        except that `batched` is not supported and raises a ValueError:
+        asyncpg prepares what it executes and can't prepare several statements at once.
         """
-        self._flush_gd(db)
-        self._flush_funcs(db)
-
-    def _flush_gd(self, db: Session) -> None:
-        source = _prep_gd_script(self._gd)
-        sql = _write_gd_sql(source)
-        db.execute(sql)
-        db.execute("SELECT _add_to_gd()")
+        if batched:
+            raise ValueError(
+                "flush_async sends every statement on its own; batched is not supported"
+            )
+        _check_chunk_size(chunk_size)
+        loop = asyncio.get_running_loop()
+        statements = await loop.run_in_executor(None, self._compile, precompile)
+        steps = _flush_steps(statements, incremental, 1, lock, wait, split=True)
+        try:
+            result = None
+            while True:
+                try:
+                    statement, params = steps.send(result)
+                except StopIteration:
+                    break
+                result = await session.execute(statement, params)
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        self._clear()
+
+    def build(self, path: str, precompile: bool = False) -> None:
+        """Writes the SQL of every registered object to a bundle file (see use_bundle).
+
+        The bundle also holds a hash of the registry and of the source file of every object,
+        which tell whether it is still up to date. The registry is not cleared.
+        `precompile` is the option flush will be called with.
+        The command line equivalent is `python -m plpy_man build <module>...`.
+        """
+        bundle = {
+            "format": _BUNDLE_FORMAT,
+            "precompile": precompile,
+            "registry": self._fingerprint(),
+            "sources": _source_hashes(self._objects(), list(self._packages.values())),
+            "statements": self._generate(precompile),
+        }
+        with open(path, "w") as f:
+            json.dump(bundle, f, indent=1)
+
+    def use_bundle(self, path: Optional[str]) -> None:
+        """Flush the SQL in a bundle written by build instead of generating it.
+
+        Objects are not inspected, so flushing skips reading and parsing their source.
+        A bundle that is missing or out of date (the registry, the source of one of its objects
+        or the precompile option differ from when it was built) is ignored with a warning
+        and the SQL is generated as usual. Pass None to stop using a bundle.
+        """
+        self._bundle = path
+
+    def diff(self, db: Session, precompile: bool = False) -> "DiffResult":
+        """
+        Compares the functions flush would create with the functions in the database
+
+        The source, argument types and return type of every function of a registered name
+        are read from pg_proc in one query. Functions that don't exist are `missing`,
+        functions whose source or return type differ are `stale` and functions of a registered
+        name with argument types that aren't registered are `orphaned`.
+        Other attributes (e.g. volatility) are not compared.
+        The functions are described by their name and argument types, as Postgres writes them.
+
+        Unless the registry or the source files of the registered objects changed,
+        the SQL generated for the previous diff is reused, so checking again only costs
+        the query (e.g. in a readiness probe). Nothing is changed and the registry is not cleared.
+        `precompile` is the option flush is called with.
+        """
+        # Registering again creates new registrations, so comparing them by identity is enough
+        registrations: List[object] = [
+            *self._gd.values(),
+            *self._registered_funcs(),
+            *self._triggers.values(),
+            *self._aggregates.values(),
+            *self._packages.values(),
+            *self._data.values(),
+        ]
+        key = (precompile, _file_versions(self._objects(), list(self._packages.values())))
+        expected = self._expected
+        if (
+            expected is None
+            or expected.key != key
+            or len(expected.registrations) != len(registrations)
+            or any(a is not b for a, b in zip(expected.registrations, registrations))
+        ):
+            functions = [
+                f
+                for sql in self._compile(precompile).values()
+                for f in _defined_functions("".join(sql))
+            ]
+            expected = self._expected = _Expected(key, registrations, functions)
+        return _diff(db, expected.functions)
+
+    def _compile(self, precompile: bool = False) -> Dict[str, List[str]]:
+        """ The SQL statements of every registered object, keyed by the object's catalog name """
+        if self._bundle is not None:
+            statements = _load_bundle(
+                self._bundle,
+                precompile,
+                self._fingerprint(),
+                self._objects(),
+                list(self._packages.values()),
+            )
+            if statements is not None:
+                return statements
+        return self._generate(precompile)
+
+    def _generate(self, precompile: bool = False) -> Dict[str, List[str]]:
+        """ Generates the SQL of every registered object """
+        try:
+            gd_script = _prep_gd_script(
+                [g["obj"] for g in self._gd.values()],
+                [g["obj"] for g in self._gd.values() if g["dependencies"]],
+            )
+            clashes = sorted(set(self._gd) & set(self._data))
+            if clashes:
+                raise ValueError(
+                    f"{', '.join(clashes)} can not be registered with both to_gd and to_gd_data."
+                )
+            serialized = self._serialize_data()
+            for name, data in serialized.items():
+                _check_data_size(name, len(data), self._data[name]["size_limit"])
+            versions = {name: _hash_bytes(data)[:16] for name, data in serialized.items()}
+            packages = list(self._packages)
+            gd_script = _with_prologues(gd_script, packages, versions)
+            gd_version = _hash(gd_script)[:16]
+            gd_script += f'\n\nGD["{_GD_VERSION}"] = "{gd_version}"\n'
+            statements = {}
+            if precompile:
+                statements[_GD_BYTECODE] = str(_write_bytecode_sql(gd_script))
+            statements[_GD_LOADER] = str(_write_gd_sql(gd_script, precompile))
+            for name, package in self._packages.items():
+                statements[f"{_MODULES}:{name}"] = str(_package_to_sql(package))
+            if packages:
+                statements[_IMPORT_HOOK] = str(_write_import_hook_sql())
+            for name, data in serialized.items():
+                serializer = self._data[name]["serializer"].__name__
+                statements[f"{_DATA}:{name}"] = str(
+                    _data_to_sql(name, serializer, versions[name], data)
+                )
+            if serialized:
+                statements[_LOAD_DATA] = str(_write_load_data_sql())
+            options: _GDOptions = {
+                "gd_version": gd_version,
+                "packages": packages,
+                "data": versions,
+            }
+            for (schema, name), overloads in self._funcs.items():
+                qualified_name = f"{schema}.{name}" if schema else name
+                for signature, f in overloads.items():
+                    catalog_name = qualified_name
+                    if len(overloads) > 1:
+                        catalog_name += f"({', '.join(signature)})"
+                    statements[catalog_name] = str(_to_sql(**f, gd=self._gd, **options))
+            if any(f["instrument"] for f in self._registered_funcs()):
+                statements[_STATS_FUNCTION] = str(_write_stats_sql())
+            # Triggers and aggregates may share a name with a function
+            for name, t in self._triggers.items():
+                statements[f"{_TRIGGER}:{name}"] = str(_trigger_to_sql(**t, **options))
+            for name, a in self._aggregates.items():
+                statements[f"{_AGGREGATE}:{name}"] = str(_aggregate_to_sql(**a, **options))
+            return {name: _split_statements(sql) for name, sql in statements.items()}
+        finally:
+            # Each source file is parsed once per flush; don't hold on to the trees afterwards
+            _source_index.clear()
+
+    def _registered_funcs(self) -> List[_ToSqlArgs]:
+        return [f for overloads in self._funcs.values() for f in overloads.values()]
+
+    def _objects(self) -> List[Any]:
+        """ Every registered object whose source is copied to the database """
+        return [
+            *(g["obj"] for g in self._gd.values()),
+            *(f["func"] for f in self._registered_funcs()),
+            *(t["func"] for t in self._triggers.values()),
+            *(a["cls"] for a in self._aggregates.values()),
+        ]
+
+    def _fingerprint(self) -> str:
+        """ A hash of what is registered and how, but not of the objects' source """
+        entries = [
+            f"gd {_qualified_name(g['obj'])} {g['dependencies']}" for g in self._gd.values()
+        ]
+        entries.extend(f"package {name}" for name in self._packages)
+        entries.extend(
+            f"data {name} {d['serializer'].__name__} {d['size_limit']} {_hash_bytes(data)}"
+            for (name, d), data in zip(self._data.items(), self._serialize_data().values())
+        )
+        registered: Sequence[Tuple[str, Sequence[Mapping[str, Any]], str]] = (
+            ("func", self._registered_funcs(), "func"),
+            ("trigger", list(self._triggers.values()), "func"),
+            ("aggregate", list(self._aggregates.values()), "cls"),
+        )
+        for kind, registrations, key in registered:
+            for args in registrations:
+                options = sorted((k, repr(v)) for k, v in args.items() if k != key)
+                entries.append(f"{kind} {_qualified_name(args[key])} {options}")
+        return _hash("\n".join(entries))
+
+    def _serialize_data(self) -> Dict[str, bytes]:
+        """ The serialized objects of to_gd_data, keyed by name """
+        for name, d in self._data.items():
+            if name not in self._serialized or self._serialized[name][0] is not d:
+                self._serialized[name] = (d, _serialize(d))
+        return {name: self._serialized[name][1] for name in self._data}
+
+    def _clear(self) -> None:
+        self._gd = {}
+        self._funcs = {}
+        self._triggers = {}
+        self._aggregates = {}
+        self._packages = {}
+        self._data = {}
+        self._serialized = {}
+
+
+# The catalog stores a hash of the SQL last flushed for each object (see PlpyMan.flush)
+_CATALOG = "plpy_man_catalog"
+_GD_LOADER = "_add_to_gd"
+# GD key holding the version of the GD script loaded into the backend
+_GD_VERSION = "__plpy_man_version__"
+# Table holding the marshalled code objects of precompiled GD scripts
+_BYTECODE = "plpy_man_bytecode"
+_GD_BYTECODE = f"{_GD_LOADER}:bytecode"
+_GD_OBJECTS = (_GD_BYTECODE, _GD_LOADER)
+# GD key telling whether the GD script was loaded from its code object
+_GD_PRECOMPILED = "__plpy_man_precompiled__"
+# Table holding the source of the modules uploaded with PlpyMan.to_package
+_MODULES = "plpy_man_modules"
+# Function installing the finder that imports them, and the GD key of the finder
+_IMPORT_HOOK = "plpy_man_import_hook"
+_FINDER = "__plpy_man_finder__"
+# Table holding the objects serialized with PlpyMan.to_gd_data, the function loading them into
+# the GD and the GD key of the versions loaded
+_DATA = "plpy_man_data"
+_LOAD_DATA = "plpy_man_load_data"
+_DATA_VERSIONS = "__plpy_man_data__"
+# Prefixes of the catalog names of triggers and aggregates
+_TRIGGER = "trigger"
+_AGGREGATE = "aggregate"
+# Version of the bundle files written by PlpyMan.build
+_BUNDLE_FORMAT = 2
+# Catalog entry holding a hash of everything a locked flush wrote
+_REGISTRY_VERSION = "plpy_man:registry"
+# Advisory lock serializing locked flushes (see PlpyMan.flush)
+_LOCK_KEY = int.from_bytes(hashlib.sha256(b"plpy_man").digest()[:8], "big", signed=True)
+
+# A statement and its parameters
+_Step = Tuple[TextClause, Any]
+
+
+class FlushResult(TypedDict):
+    """ The outcome of flushing to one of the targets of PlpyMan.flush_many """
+
+    target: Union[Session, Engine]
+    error: Optional[Exception]
+    seconds: float
+
+
+class DiffResult(TypedDict):
+    """ The functions PlpyMan.diff found to differ from the registry, e.g. `add(integer)` """
+
+    missing: List[str]
+    stale: List[str]
+    orphaned: List[str]
+
+
+def _database_only(
+    func: Callable[..., Any], decorator: str = "plpy_func"
+) -> Callable[..., NoReturn]:
+    """ Stands in for a function that was registered to only run in the database """
+
+    def wrapper(*args: Any, **kwargs: Any) -> NoReturn:
+        raise TypeError(
+            f"{func.__name__} was registered as a {decorator}. "
+            f"This means that only the database can run this function.\n\n"
+            f"Were you trying to write a function that both "
+            f"this script AND Plpython could accesses?\n"
+            f"Instead of decorating {func.__name__} with {decorator}, "
+            f"use something like `plpy_man.to_gd({func.__name__})`. "
+            f"Then you can access this function in the GD of plpy functions while "
+            f"still being able to call this function normally."
+        )
+
+    wrapper.__wrapped__ = func  # type: ignore
+    return wrapper
+
+
+def _execute(db: Session, steps: Generator[_Step, Any, None]) -> None:
+    """ Runs the steps of a flush in one transaction """
+    try:
+        result = None
+        while True:
+            try:
+                statement, params = steps.send(result)
+            except StopIteration:
+                break
+            result = db.execute(statement, params)
         db.commit()
-        self._gd = []
+    except Exception:
+        db.rollback()
+        raise
+
 
-    def _flush_funcs(self, db: Session) -> None:
-        for f in self._funcs:
-            sql = _to_sql(**f)
-            db.execute(sql)
-        self._funcs = []
+def _check_chunk_size(chunk_size: int) -> None:
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be a positive integer, not {chunk_size}")
 
 
-def _prep_gd_script(objs: Sequence[Callable]) -> str:
+def _read_version_sql(catalog: str = _CATALOG) -> text:
+    """
+    Selects the registry version, or no row if the catalog doesn't exist yet.
+    query_to_xml runs the SELECT, so it's only planned once to_regclass found the catalog.
+    """
+    return text(
+        "SELECT (xpath('/table/row/hash/text()', query_to_xml("
+        "format('SELECT hash FROM %s WHERE name = %L', "
+        f"to_regclass('{catalog}'), CAST(:name AS TEXT)), false, false, '')))[1]::text "
+        f"WHERE to_regclass('{catalog}') IS NOT NULL"
+    )
+
+
+def _flush_steps(
+    statements: Dict[str, List[str]],
+    incremental: bool,
+    chunk_size: int,
+    lock: bool = False,
+    wait: bool = True,
+    split: bool = False,
+) -> Generator[_Step, Any, None]:
+    """
+    The statements of a flush, independent of how they are executed.
+    Each step is sent the result of executing the previous one.
+    The statements of an object are sent together unless `split` is set.
+    """
+    hashes = {name: _hash("".join(sql)) for name, sql in statements.items()}
+    if lock:
+        version = _hash("".join(f"{name}:{hashes[name]}\n" for name in sorted(hashes)))
+        # Up to date registries are the common case, so the version is read before locking
+        stored_version = yield _read_version_sql(), {"name": _REGISTRY_VERSION}
+        if stored_version.scalar() == version:
+            return
+        # The lock is released when the flush's transaction ends
+        if wait:
+            yield text("SELECT pg_advisory_xact_lock(:key)"), {"key": _LOCK_KEY}
+        else:
+            acquired = yield text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": _LOCK_KEY}
+            if not acquired.scalar():
+                return  # Another session is flushing
+    if incremental or lock:
+        yield text(
+            f"CREATE TABLE IF NOT EXISTS {_CATALOG} (name TEXT PRIMARY KEY, hash TEXT NOT NULL)"
+        ), None
+    if lock:
+        stored_version = yield text(f"SELECT hash FROM {_CATALOG} WHERE name = :name"), {
+            "name": _REGISTRY_VERSION
+        }
+        if stored_version.scalar() == version:
+            return  # Flushed by the worker that held the lock
+    if incremental:
+        rows = yield text(f"SELECT name, hash FROM {_CATALOG} WHERE name = ANY(:names)"), {
+            "names": list(hashes)
+        }
+        stored = {name: hash_ for name, hash_ in rows}
+        statements = {
+            name: sql for name, sql in statements.items() if stored.get(name) != hashes[name]
+        }
+
+    pieces = {name: sql if split else ["".join(sql)] for name, sql in statements.items()}
+    # The GD script may import uploaded modules, so they're stored before it's run
+    first = [name for name in statements if _runs_first(name)]
+    for name in first:
+        for sql in pieces[name]:
+            yield text(sql), None
+    yield text(f"SELECT {_GD_LOADER}()"), None
+
+    funcs = [sql for name in statements if name not in first for sql in pieces[name]]
+    for i in range(0, len(funcs), chunk_size):
+        yield text("\n".join(funcs[i : i + chunk_size])), None
+
+    flushed = {name: hashes[name] for name in statements} if incremental else {}
+    if lock:
+        flushed[_REGISTRY_VERSION] = version
+    if flushed:
+        yield text(
+            f"INSERT INTO {_CATALOG} (name, hash) VALUES (:name, :hash) "
+            f"ON CONFLICT (name) DO UPDATE SET hash = excluded.hash"
+        ), [{"name": name, "hash": hash_} for name, hash_ in flushed.items()]
+
+
+# A statement's end: the semicolons in string literals, quoted identifiers, dollar-quoted
+# bodies and comments are skipped by matching them as a whole
+_STATEMENT_END = re.compile(
+    r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|(\$(?:[A-Za-z_]\w*)?\$)[\s\S]*?\1|--[^\n]*|(;)"
+)
+
+
+def _split_statements(sql: str) -> List[str]:
+    """
+    Splits SQL into its statements.
+    The whitespace between them is kept, so the statements join back into `sql`.
+    """
+    statements = []
+    start = 0
+    for match in _STATEMENT_END.finditer(sql):
+        if match.group(2):
+            statements.append(sql[start : match.end()])
+            start = match.end()
+    if sql[start:].strip() or not statements:
+        statements.append(sql[start:])
+    else:
+        statements[-1] += sql[start:]
+    return statements
+
+
+def _runs_first(name: str) -> bool:
+    """ Whether a statement is run before the GD is loaded and the functions are created """
+    return (
+        name in _GD_OBJECTS
+        or name in (_IMPORT_HOOK, _LOAD_DATA)
+        or name.startswith((f"{_MODULES}:", f"{_DATA}:"))
+    )
+
+
+def _qualified_name(obj: Any) -> str:
+    return f"{obj.__module__}:{obj.__qualname__}"
+
+
+def _source_hashes(
+    objs: Sequence[Any], packages: Sequence[ModuleType] = ()
+) -> Dict[str, Optional[str]]:
+    """
+    A hash of the source file of every object, keyed by the object's qualified name,
+    and of every module of the packages, keyed by the module's name.
+    The generator itself (this module) is included, as its output changes with its source.
+    """
+    file_hashes: Dict[str, Optional[str]] = {}
+    hashes = {}
+    for obj in [*objs, _source_hashes]:
+        try:
+            path = inspect.getsourcefile(inspect.unwrap(obj))
+        except TypeError:
+            path = None
+        if path not in file_hashes:
+            try:
+                with open(path, "rb") as f:  # type: ignore
+                    file_hashes[path] = hashlib.sha256(f.read()).hexdigest()  # type: ignore
+            except (OSError, TypeError):
+                file_hashes[path] = None  # type: ignore
+        hashes[_qualified_name(obj)] = file_hashes[path]  # type: ignore
+    for package in packages:
+        for name, (path, _) in _package_modules(package).items():
+            with open(path, "rb") as f:
+                hashes[name] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+
+def _load_bundle(
+    path: str,
+    precompile: bool,
+    fingerprint: str,
+    objs: Sequence[Any],
+    packages: Sequence[ModuleType] = (),
+) -> Optional[Dict[str, List[str]]]:
+    """ The statements of a bundle written by PlpyMan.build, or None if it is out of date """
+    try:
+        with open(path) as f:
+            bundle = json.load(f)
+    except (OSError, ValueError) as err:
+        reason = f"it could not be read ({err})"
+    else:
+        if bundle.get("format") != _BUNDLE_FORMAT:
+            reason = "it was built by a different version of plpy_man"
+        elif bundle["precompile"] != precompile:
+            reason = "it was built with a different precompile option"
+        elif bundle["registry"] != fingerprint:
+            reason = "the registered objects or their options changed"
+        elif bundle["sources"] != _source_hashes(objs, packages):
+            reason = "the source of a registered object changed"
+        else:
+            statements: Dict[str, List[str]] = bundle["statements"]
+            return statements
+    warnings.warn(
+        f"Not using the SQL bundle {path} because {reason}. "
+        f"The SQL is generated instead; rebuild the bundle to skip generating it.",
+        stacklevel=4,
+    )
+    return None
+
+
+def _hash(sql: str) -> str:
+    return _hash_bytes(sql.encode())
+
+
+def _hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _prep_gd_script(objs: Sequence[Callable], analyzed: Sequence[Callable] = ()) -> str:
+    """ The script adding objects to the GD, preceded by the dependencies of those `analyzed` """
     source: List[str] = []
-    for obj in objs:
-        source.append(textwrap.dedent(inspect.getsource(obj)))
+    for obj, definitions in _gd_definitions(objs, analyzed):
+        source.extend(definitions)
         source.append(f'\nGD["{obj.__name__}"] = {obj.__name__}\n\n')
     return "\n".join(source)[:-1]  # The final extraneous line is trimmed
 
 
-def _write_gd_sql(py_script: str) -> text:
+def _gd_definitions(
+    objs: Sequence[Callable], analyzed: Sequence[Callable] = ()
+) -> Iterator[Tuple[Any, List[str]]]:
+    """ Each object with the source that defines it, which is empty if it was already defined """
+    dependencies = _Dependencies()
+    for obj in objs:
+        source: List[str] = []
+        if any(obj is a for a in analyzed):
+            source.extend(dependencies.add(obj))
+        if not dependencies.defines(obj):
+            source.append(textwrap.dedent(_source_index.getsource(obj)))
+            dependencies.define(obj)
+        yield obj, source
+
+
+# Names PlPython defines for every function (including _add_to_gd)
+_PLPYTHON_GLOBALS = frozenset(("GD", "SD", "TD", "plpy"))
+
+
+class _Dependencies:
+    """
+    Finds the module-level definitions and imports that objects copied to the GD depend on.
+
+    Every global name an object's source uses is looked up in the statement that binds it
+    at the top level of its module. The source of definitions and assignments is copied
+    after the dependencies of that source; names imported from the application are found in
+    the module they are imported from, and imports of installed modules are copied as they are.
+    Each statement is copied once, before anything that uses it.
+    """
+
+    def __init__(self) -> None:
+        self._source: List[str] = []
+        self._seen: Set[Tuple[str, str]] = set()
+
+    def add(self, obj: Any) -> List[str]:
+        """ The source of the dependencies of an object that have not been added yet """
+        start = len(self._source)
+        self._add_names(obj.__module__, textwrap.dedent(_source_index.getsource(obj)))
+        return self._source[start:]
+
+    def defines(self, obj: Any) -> bool:
+        return (obj.__module__, obj.__qualname__) in self._seen
+
+    def define(self, obj: Any) -> None:
+        self._seen.add((obj.__module__, obj.__qualname__))
+
+    def _add_names(self, module_name: str, source: str) -> None:
+        module = sys.modules.get(module_name)
+        if module is None:
+            return
+        for name in sorted(_global_names(source) - _PLPYTHON_GLOBALS):
+            if name in vars(module):
+                self._add(module, name)
+
+    def _add(self, module: ModuleType, name: str) -> None:
+        if (module.__name__, name) in self._seen:
+            return
+        self._seen.add((module.__name__, name))
+        value = vars(module)[name]
+        found = _source_index.binding(module, name)
+        if found is None:
+            self._source.append(_assignment(module, name, value))
+            return
+        parsed, node = found
+        if isinstance(node, ast.Import):
+            alias = next(a for a in node.names if (a.asname or a.name.split(".")[0]) == name)
+            self._source.append(f"import {alias.name}{_as(alias)}")
+        elif isinstance(node, ast.ImportFrom):
+            alias = next(a for a in node.names if (a.asname or a.name) == name)
+            package = "." * node.level + (node.module or "")
+            imported_from = importlib.util.resolve_name(package, module.__package__)
+            origin = sys.modules.get(imported_from)
+            if (
+                origin is None
+                or isinstance(value, ModuleType)
+                or _is_installed(imported_from)
+                or alias.name not in vars(origin)
+            ):
+                self._source.append(f"from {imported_from} import {alias.name}{_as(alias)}")
+            else:
+                self._add(origin, alias.name)
+                if alias.name != name:
+                    self._source.append(f"{name} = {alias.name}")
+        else:
+            source = textwrap.dedent(_statement_source(parsed, node))
+            self._add_names(module.__name__, source)
+            self._source.append(source)
+
+
+def _global_names(source: str) -> Set[str]:
+    """ The global names a piece of source uses but does not bind """
+    table = symtable.symtable(source, "<gd>", "exec")
+    symbols = table.get_symbols()
+    bound = {s.get_name() for s in symbols if s.is_assigned() or s.is_imported()}
+    names = {s.get_name() for s in symbols if s.is_referenced()}
+    scopes = table.get_children()
+    while scopes:
+        scope = scopes.pop()
+        names.update(
+            s.get_name() for s in scope.get_symbols() if s.is_referenced() and s.is_global()
+        )
+        scopes.extend(scope.get_children())
+    return names - bound
+
+
+def _statement_source(parsed: "_ParsedFile", node: ast.stmt) -> str:
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return "".join(parsed.lines[_first_line(node) - 1 : _last_line(parsed.lines, node)])
+    return "".join(parsed.lines[node.lineno - 1 : node.end_lineno])
+
+
+def _assignment(module: ModuleType, name: str, value: Any) -> str:
+    """ Source defining a global whose definition could not be found, if it's a literal """
+    if isinstance(value, ModuleType):
+        return f"import {value.__name__} as {name}"
+    try:
+        if ast.literal_eval(repr(value)) == value:
+            return f"{name} = {value!r}"
+    except (ValueError, SyntaxError):
+        pass
+    raise ValueError(
+        f"{module.__name__}.{name} is used by an object copied to the GD, "
+        f"but its definition could not be found. Copy it to the GD with to_gd instead."
+    )
+
+
+def _as(alias: ast.alias) -> str:
+    return f" as {alias.asname}" if alias.asname else ""
+
+
+# Directories of the standard library and of installed packages
+_INSTALLED_PATHS = tuple(
+    os.path.join(os.path.realpath(path), "")
+    for scheme, path in sysconfig.get_paths().items()
+    if scheme in ("stdlib", "platstdlib", "purelib", "platlib")
+)
+
+
+def _is_installed(module_name: str) -> bool:
+    """ Whether a module comes with Python or is installed, rather than part of the application """
+    package = module_name.split(".")[0]
+    if package in sys.builtin_module_names:
+        return True
+    path: Optional[str] = getattr(sys.modules.get(package), "__file__", None)
+    if not path:
+        return False
+    return os.path.realpath(path).startswith(_INSTALLED_PATHS)
+
+
+def _write_gd_sql(py_script: str, precompiled: bool = False) -> text:
+    if precompiled:
+        py_script = _precompiled_loader(py_script)
     return text(
         f"""\
 CREATE OR REPLACE FUNCTION _add_to_gd()
@@ -113,6 +1186,44 @@ $$ LANGUAGE plpython3u;
     )
 
 
+def _precompiled_loader(py_script: str) -> str:
+    """
+    Python that executes the marshalled GD script stored by _write_bytecode_sql.
+    The source is kept as a fallback for backends running a different Python version.
+    Which of them ran is stored in GD[_GD_PRECOMPILED].
+    """
+    return f"""\
+import importlib.util
+import marshal
+namespace = {{"__name__": "{_GD_LOADER}", "GD": GD, "SD": SD, "plpy": plpy}}
+rows = plpy.execute("SELECT magic, code FROM {_BYTECODE} WHERE name = '{_GD_LOADER}'")
+if rows.nrows() and rows[0]["magic"] == importlib.util.MAGIC_NUMBER.hex():
+    exec(marshal.loads(rows[0]["code"]), namespace)
+    GD["{_GD_PRECOMPILED}"] = True
+else:
+    exec({py_script!r}, namespace)
+    GD["{_GD_PRECOMPILED}"] = False
+"""
+
+
+def _write_bytecode_sql(py_script: str) -> text:
+    code = marshal.dumps(compile(py_script, f"<{_GD_LOADER}>", "exec"))
+    return text(
+        f"""\
+CREATE TABLE IF NOT EXISTS {_BYTECODE} (
+  name TEXT PRIMARY KEY, magic TEXT NOT NULL, code BYTEA NOT NULL
+);
+INSERT INTO {_BYTECODE} (name, magic, code)
+VALUES (
+  '{_GD_LOADER}',
+  '{importlib.util.MAGIC_NUMBER.hex()}',
+  decode('{base64.b64encode(code).decode()}', 'base64')
+)
+ON CONFLICT (name) DO UPDATE SET magic = excluded.magic, code = excluded.code;
+"""
+    )
+
+
 class _Inspected(TypedDict):
     name: str
     args: Tuple[str, ...]
@@ -132,8 +1243,27 @@ def _inspect_function(func: Callable) -> _Inspected:
 
 
 def _get_func_body(func: Callable) -> str:
-    lines = inspect.getsource(func)
-    source = textwrap.dedent(lines)
+    body = _source_index.body(func)
+    if body is not None:
+        return body
+    return _inspect_func_body(func)
+
+
+def _dedent_definition(lines: List[str]) -> str:
+    """
+    Dedents the source of a definition by the indentation of its first line.
+    Like textwrap.dedent, but lines indented less (in a multi-line string) are left as they are
+    instead of leaving the whole definition indented.
+    """
+    margin = len(lines[0]) - len(lines[0].lstrip())
+    return "".join(
+        line[margin:] if len(line) > margin and line[:margin].isspace() else line for line in lines
+    )
+
+
+def _inspect_func_body(func: Callable) -> str:
+    lines, _ = inspect.getsourcelines(func)
+    source = _dedent_definition(lines)
     _ast = ast.parse(source)
     _func_body = _ast.body[0].body  # Todo: Why doesn't mypy like this?
     segments = []
@@ -142,6 +1272,191 @@ def _get_func_body(func: Callable) -> str:
     return "\n".join(segments)
 
 
+_Definition = Union[ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef]
+
+
+class _ParsedFile:
+    """ The lines of a source file and its function and class definitions """
+
+    def __init__(self, mtime: int, lines: List[str]) -> None:
+        self.mtime = mtime
+        self.lines = lines
+        # Functions are found by the line their code object starts on, classes by their qualname
+        self.by_line: Dict[int, _Definition] = {}
+        self.by_qualname: Dict[str, _Definition] = {}
+        # The last statement at the top level of the module binding each name
+        self.bindings: Dict[str, ast.stmt] = {}
+        tree = ast.parse("".join(lines))
+        self._index(tree, "")
+        for statement in tree.body:
+            for name in _bound_names(statement):
+                self.bindings[name] = statement
+
+    def _index(self, node: ast.AST, prefix: str) -> None:
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                self.by_line.setdefault(_first_line(child), child)
+                qualname = prefix + child.name
+                if isinstance(child, ast.ClassDef):
+                    self.by_qualname.setdefault(qualname, child)
+                    self._index(child, f"{qualname}.")
+                else:
+                    self._index(child, f"{qualname}.<locals>.")
+            elif not isinstance(child, ast.expr):  # Expressions cannot contain definitions
+                self._index(child, prefix)
+
+
+def _bound_names(statement: ast.stmt) -> List[str]:
+    if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return [statement.name]
+    if isinstance(statement, ast.Import):
+        return [alias.asname or alias.name.split(".")[0] for alias in statement.names]
+    if isinstance(statement, ast.ImportFrom):
+        return [alias.asname or alias.name for alias in statement.names if alias.name != "*"]
+    if isinstance(statement, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+        targets = statement.targets if isinstance(statement, ast.Assign) else [statement.target]
+        return [
+            node.id
+            for target in targets
+            for node in ast.walk(target)
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)
+        ]
+    return []
+
+
+class _SourceIndex:
+    """
+    Cache of parsed source files, keyed by path and modification time.
+
+    Registering many objects from the same module would otherwise tokenize and parse
+    that module's file once per object (inspect.getsource followed by ast.parse).
+    Objects whose source cannot be found in a file fall back to inspect.
+    """
+
+    def __init__(self) -> None:
+        self._files: Dict[str, _ParsedFile] = {}
+
+    def clear(self) -> None:
+        self._files.clear()
+
+    def getsource(self, obj: Any) -> str:
+        """ Equivalent to inspect.getsource """
+        found = self._find(obj)
+        if found is None:
+            return inspect.getsource(obj)
+        parsed, node = found
+        return "".join(parsed.lines[_first_line(node) - 1 : _last_line(parsed.lines, node)])
+
+    def body(self, func: Callable) -> Optional[str]:
+        """ The statements of a function's body, dedented as if the function was defined alone """
+        found = self._find(func)
+        if found is None:
+            return None
+        parsed, node = found
+        first_line = parsed.lines[_first_line(node) - 1]
+        margin = len(first_line) - len(first_line.lstrip())
+        segments = []
+        for statement in node.body:
+            segment = _get_source_segment(parsed.lines, statement, margin)
+            if segment is None:
+                return None  # Left to _inspect_func_body
+            segments.append(_dedent(segment))
+        return "\n".join(segments)
+
+    def binding(self, module: ModuleType, name: str) -> Optional[Tuple[_ParsedFile, ast.stmt]]:
+        """ The statement at the top level of a module that binds a name """
+        try:
+            path = inspect.getsourcefile(module)
+        except TypeError:
+            return None
+        parsed = self._parse(path) if path else None
+        if parsed is None or name not in parsed.bindings:
+            return None
+        return parsed, parsed.bindings[name]
+
+    def _find(self, obj: Any) -> Optional[Tuple[_ParsedFile, _Definition]]:
+        if inspect.ismethod(obj):
+            obj = obj.__func__
+        if inspect.isfunction(obj):
+            obj = inspect.unwrap(obj)
+        try:
+            path = inspect.getsourcefile(obj)
+        except TypeError:
+            return None
+        parsed = self._parse(path) if path else None
+        if parsed is None:
+            return None
+        node: Optional[_Definition]
+        if inspect.isclass(obj):
+            node = parsed.by_qualname.get(obj.__qualname__)
+        elif inspect.isfunction(obj):
+            node = parsed.by_line.get(obj.__code__.co_firstlineno)
+            if node is not None and node.name != obj.__code__.co_name:
+                node = None  # e.g. a lambda on the same line as a def
+        else:
+            node = None
+        return (parsed, node) if node is not None else None
+
+    def _parse(self, path: str) -> Optional[_ParsedFile]:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        parsed = self._files.get(path)
+        if parsed is None or parsed.mtime != mtime:
+            try:
+                with tokenize.open(path) as f:
+                    parsed = _ParsedFile(mtime, f.readlines())
+            except (OSError, SyntaxError, UnicodeDecodeError):
+                return None
+            self._files[path] = parsed
+        return parsed
+
+
+def _first_line(node: _Definition) -> int:
+    """ The line a definition's code object starts on (its first decorator, if it has any) """
+    return min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+
+
+def _last_line(lines: List[str], node: _Definition) -> int:
+    """ The last line of a definition, including trailing comments indented like its body """
+    last: int = node.end_lineno  # type: ignore
+    if node.body[0].lineno == node.lineno:  # e.g. `def f(): pass`
+        return last
+    body_indent = node.body[0].col_offset
+    for number, line in enumerate(lines[last:], start=last + 1):
+        stripped = line.lstrip()
+        if not stripped:
+            continue
+        if not stripped.startswith("#"):
+            break
+        if len(line) - len(stripped) >= body_indent:
+            last = number
+    return last
+
+
+def _get_source_segment(lines: List[str], node: ast.AST, margin: int) -> Optional[str]:
+    """
+    ast.get_source_segment for a node in source that is dedented by `margin` columns,
+    or None if a line of the node starts within the margin (e.g. in a multi-line string)
+    """
+    selected = []
+    for line in lines[node.lineno - 1 : node.end_lineno]:  # type: ignore
+        if not line.strip():
+            selected.append("\n")
+        elif not margin or line[:margin].isspace():
+            selected.append(line[margin:])
+        else:
+            return None
+    # Like ast, column offsets are counted in utf-8 bytes
+    selected[-1] = selected[-1].encode()[: node.end_col_offset - margin].decode()  # type: ignore
+    selected[0] = selected[0].encode()[node.col_offset - margin :].decode()  # type: ignore
+    return "".join(selected)
+
+
+_source_index = _SourceIndex()
+
+
 # Local copy of SQLAlchemy's private type map
 # Copyright (C) 2005-2021 the SQLAlchemy authors and contributors
 _type_map = {
@@ -163,24 +1478,42 @@ def _to_sql(
     func: Callable[..., Any],
     argtypes: Optional[Sequence[Type_]] = None,
     rettype: Type_ = "",
+    lazy_gd: bool = False,
+    gd_version: str = "",
+    volatility: Optional[str] = None,
+    parallel: Optional[str] = None,
+    strict: bool = False,
+    leakproof: bool = False,
+    cost: Optional[float] = None,
+    rows: Optional[float] = None,
+    config: Optional[Mapping[str, str]] = None,
+    batched: bool = False,
+    instrument: bool = False,
+    schema: Optional[str] = None,
+    inline_gd: bool = False,
+    gd: Optional[Mapping[str, _GDArgs]] = None,
+    packages: Sequence[str] = (),
+    data: Optional[Mapping[str, str]] = None,
+    name: str = "",
 ) -> text:
-    class ListAppender(list):
-        def __call__(self, *args: Any) -> None:
-            [self.append(arg) for arg in args]
-
-    SQL_INDENT = "  "  # 2 spaces
-    PY_INDENT = "    "  # 4 spaces
-    SPACE = " "  # Single Space
-    NL = "\n"
-
     # Inspect code to get source
     func_parts = _inspect_function(func)
-    name = func_parts["name"]
+    name = name or func_parts["name"]
+    if schema:
+        name = f"{schema}.{name}"
     args = func_parts["args"]
     annotations = func_parts["annotations"]
     body = func_parts["body"]
-
-    name_clause = f"CREATE OR REPLACE FUNCTION {name}"
+    _check_attributes(volatility, parallel)
+    if volatility and volatility.upper() == "IMMUTABLE" and _queries_database(body):
+        warnings.warn(
+            f"{name} is IMMUTABLE but queries the database with plpy. "
+            f"Postgres may pre-evaluate calls to immutable functions, "
+            f"so query results can be cached in plans; mark it STABLE instead.",
+            stacklevel=2,
+        )
+    prologue = _lazy_gd_prologue(gd_version) if lazy_gd else ""
+    converted_body = _with_ndarray_conversions(args, annotations, body)
 
     # Argument Clause
     _argtypes: List[str] = []
@@ -196,22 +1529,9 @@ def _to_sql(
                     f"You can also use pass annotations types to plpy_func as SQLAlchemy Types "
                     f"or string literals."
                 )
-            _annotated_type = annotations[arg]
-            try:
-                _type = _type_map[_annotated_type]
-            except KeyError as err:
-                err.args = [
-                    f"{_annotated_type} could not be coerced to a Postgresql type. "
-                    f"Try passing the SQLAlchemy type (or a string literal) to plpy_func instead."
-                ]
-                raise err
-            _argtypes.append(str(_type))
+            _argtypes.append(_map_type(annotations[arg]))
     args_and_types: List[Tuple[str, str]]
-    args_and_types = [(name, _type) for name, _type in zip(args, _argtypes)]
-    _arg_string = ", ".join(
-        [(lambda _arg, _type: f"{_arg} {_type}")(*item) for item in args_and_types]
-    )
-    argument_clause = "".join(f"({_arg_string})")
+    args_and_types = [(arg, _type) for arg, _type in zip(args, _argtypes)]
 
     _return_type: str
     if rettype:
@@ -225,24 +1545,100 @@ def _to_sql(
                 f"or string literals."
             )
         _annotated_type = annotations["return"]
+        if _annotated_type is not None:
+            _return_type = _map_return_type(_annotated_type)
+        else:
+            _return_type = ""
+    attributes = _function_attributes(volatility, parallel, strict, leakproof, cost, rows, config)
+
+    function_body = _instrumented(name, converted_body) if instrument else converted_body
+    if inline_gd:
+        function_body = _inline_gd(name, args, function_body, gd or {})
+    function_body = _with_prologues(function_body, packages, data or {})
+    sql = _create_function(
+        name, args_and_types, _return_type, prologue + function_body, attributes
+    )
+    if batched:
+        if converted_body != body:
+            raise ValueError(f"{name} can not be batched because it converts numpy arrays.")
+        if not args or not _return_type or _return_type.upper().startswith(("SETOF", "TABLE")):
+            raise ValueError(
+                f"{name} can not be batched. "
+                f"Only functions that take arguments and return a single value can be batched."
+            )
+        # The Python function is named without the schema
+        batch_body = _batch_body(name.rpartition(".")[2], args, body, strict)
+        if instrument:
+            batch_body = _instrumented(f"{name}_batch", batch_body)
+        if inline_gd:
+            batch_body = _inline_gd(f"{name}_batch", args, batch_body, gd or {})
+        batch_body = _with_prologues(batch_body, packages, data or {})
+        # NULL arrays return NULL, hence STRICT
+        batch_attributes = _function_attributes(
+            volatility, parallel, True, leakproof, cost, None, config
+        )
+        sql += _create_function(
+            f"{name}_batch",
+            [(arg, f"{_type}[]") for arg, _type in args_and_types],
+            f"{_return_type}[]",
+            prologue + batch_body,
+            batch_attributes,
+        )
+    return text(sql)
+
+
+def _signature(argtypes: Sequence[Type_]) -> _Signature:
+    """ Argument types, normalized to compare signatures (see PlpyMan.get) """
+    signature = []
+    for _type in argtypes:
+        if not isinstance(_type, (str, TypeEngine)) and not (
+            isinstance(_type, type) and issubclass(_type, TypeEngine)
+        ):
+            _type = _map_type(_type)
+        signature.append(_stringify_type(_type).upper())
+    return tuple(signature)
+
+
+def _registered_signature(args: _ToSqlArgs) -> _Signature:
+    """ The signature of a function registered by plpy_func """
+    if args["argtypes"] is not None:
+        return _signature(args["argtypes"])
+    code = args["func"].__code__
+    annotations = args["func"].__annotations__
+    signature = []
+    for arg in code.co_varnames[: code.co_argcount]:
         try:
-            if _annotated_type is not None:
-                _return_type = _type_map[_annotated_type]
-            else:
-                _return_type = ""
-        except KeyError as err:
-            err.args = [
-                f"{_annotated_type} could not be coerced to a Postgresql type. "
-                f"Try passing the SQLAlchemy type (or a string literal) to plpy_func instead."
-            ]
-            raise err
-    return_clause = f"RETURNS {_return_type}" if _return_type else ""
+            signature.append(_signature([annotations[arg]])[0])
+        except KeyError:
+            # Reported when the function is flushed
+            signature.append(repr(annotations.get(arg)))
+    return tuple(signature)
+
+
+def _create_function(
+    name: str, args_and_types: List[Tuple[str, str]], return_type: str, body: str, attributes: str
+) -> str:
+    class ListAppender(list):
+        def __call__(self, *args: Any) -> None:
+            [self.append(arg) for arg in args]
+
+    SQL_INDENT = "  "  # 2 spaces
+    PY_INDENT = "    "  # 4 spaces
+    SPACE = " "  # Single Space
+    NL = "\n"
+
+    name_clause = f"CREATE OR REPLACE FUNCTION {name}"
+    _arg_string = ", ".join(
+        [(lambda _arg, _type: f"{_arg} {_type}")(*item) for item in args_and_types]
+    )
+    argument_clause = "".join(f"({_arg_string})")
+    return_clause = f"RETURNS {return_type}" if return_type else ""
     as_clause = "AS $$"
-    language_clause = "$$ LANGUAGE plpython3u;"
+    language_clause = f"$$ LANGUAGE plpython3u{attributes};"
 
     s = ListAppender()
     s(name_clause)
-    if args:
+    if args_and_types:
         s(SPACE)
     s(argument_clause)
     if return_clause:
@@ -253,8 +1649,855 @@ def _to_sql(
     s(as_clause, NL)
     s(textwrap.indent(body, PY_INDENT), NL)
     s(language_clause, NL)
+    return "".join(s)
+
+
+def _file_versions(objs: Sequence[Any], packages: Sequence[ModuleType]) -> Dict[str, int]:
+    """ The modification time of the module file of every object and of the packages' modules """
+    paths: Set[Optional[str]] = {
+        getattr(sys.modules.get(obj.__module__), "__file__", None) for obj in objs
+    }
+    paths.update(path for package in packages for path, _ in _package_modules(package).values())
+    versions = {}
+    for path in paths:
+        if path is None:
+            continue
+        try:
+            versions[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+    return versions
+
+
+class _DefinedFunction(NamedTuple):
+    """ A function created by generated SQL """
+
+    schema: Optional[str]
+    name: str
+    argtypes: Tuple[str, ...]
+    rettype: str
+    retset: bool
+    source: str
+
+
+def _defined_functions(sql: str) -> List[_DefinedFunction]:
+    """ The functions the CREATE FUNCTION statements of generated SQL create """
+    functions = []
+    start = sql.find(_CREATE_FUNCTION)
+    while start != -1:
+        position = start + len(_CREATE_FUNCTION)
+        open_paren = sql.index("(", position)
+        qualified_name = sql[position:open_paren].strip()
+        close_paren = _closing_paren(sql, open_paren)
+        body_start = sql.index("AS $$", close_paren)
+        body_end = sql.index("$$ LANGUAGE", body_start)
+        returns = sql[close_paren + 1 : body_start].strip()
+        schema, _, name = qualified_name.rpartition(".")
+        functions.append(
+            _DefinedFunction(
+                schema.lower() or None,
+                name.lower(),
+                tuple(
+                    # Arguments are written as `[VARIADIC] name type`
+                    arg.split(None, 2 if arg.upper().startswith("VARIADIC ") else 1)[-1]
+                    for arg in _split_args(sql[open_paren + 1 : close_paren])
+                ),
+                *_return_type(returns[len("RETURNS") :].strip() if returns else "void"),
+                sql[body_start + len("AS $$") : body_end],
+            )
+        )
+        start = sql.find(_CREATE_FUNCTION, body_end)
+    return functions
+
+
+_CREATE_FUNCTION = "CREATE OR REPLACE FUNCTION "
+
+
+def _closing_paren(sql: str, open_paren: int) -> int:
+    depth = 0
+    for i in range(open_paren, len(sql)):
+        if sql[i] == "(":
+            depth += 1
+        elif sql[i] == ")":
+            depth -= 1
+            if not depth:
+                return i
+    raise ValueError(f"Unbalanced parentheses in {sql[open_paren:]}")
+
+
+def _split_args(arg_list: str) -> List[str]:
+    """ Splits an argument list on the commas that are not in a type (e.g. NUMERIC(10, 2)) """
+    args, depth, start = [], 0, 0
+    for i, char in enumerate(arg_list):
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        if char == "," and not depth:
+            args.append(arg_list[start:i].strip())
+            start = i + 1
+    args.append(arg_list[start:].strip())
+    return [arg for arg in args if arg]
+
+
+def _return_type(returns: str) -> Tuple[str, bool]:
+    """ The type a function's RETURNS clause names and whether it returns a set """
+    if returns.upper().startswith("TABLE"):
+        return "record", True
+    if returns.upper().startswith("SETOF "):
+        return returns[len("SETOF ") :].strip(), True
+    return returns, False
+
+
+# Postgres writes the types (e.g. `VARCHAR` as `character varying`), so the query normalizes them
+_DIFF_QUERY = """\
+SELECT
+  (SELECT json_object_agg(t, to_regtype(t)::text) FROM unnest(CAST(:types AS TEXT[])) AS t),
+  (
+    SELECT json_agg(json_build_array(
+      n.nspname, p.proname, pg_function_is_visible(p.oid), p.proargtypes::regtype[]::text[],
+      p.prorettype::regtype::text, p.proretset, p.prosrc
+    ))
+    FROM pg_proc p
+    JOIN pg_namespace n ON n.oid = p.pronamespace
+    JOIN pg_language l ON l.oid = p.prolang
+    WHERE l.lanname = 'plpython3u' AND p.proname = ANY(CAST(:names AS TEXT[]))
+  )
+"""
+
+
+def _diff(db: Session, expected: Sequence[_DefinedFunction]) -> DiffResult:
+    types = {t for f in expected for t in (*f.argtypes, f.rettype)}
+    row = db.execute(
+        text(_DIFF_QUERY), {"types": sorted(types), "names": sorted({f.name for f in expected})}
+    ).one()
+    normalized: Dict[str, Optional[str]] = row[0] or {}
+    found = row[1] or []
+
+    def describe(name: str, schema: Optional[str], argtypes: Sequence[Optional[str]]) -> str:
+        qualified_name = f"{schema}.{name}" if schema else name
+        return f"{qualified_name}({', '.join(t or '?' for t in argtypes)})"
+
+    by_signature: Dict[Tuple[str, Tuple[Optional[str], ...]], List[int]] = {}
+    for i, (_, name, _, db_argtypes, *_) in enumerate(found):
+        by_signature.setdefault((name, tuple(db_argtypes)), []).append(i)
+
+    result: DiffResult = {"missing": [], "stale": [], "orphaned": []}
+    matched = set()
+    for f in expected:
+        argtypes = tuple(normalized.get(t) for t in f.argtypes)
+        # Unqualified names are the functions the search path finds
+        match = next(
+            (
+                i
+                for i in by_signature.get((f.name, argtypes), [])
+                if (found[i][0] == f.schema if f.schema else found[i][2])
+            ),
+            None,
+        )
+        if match is None:
+            result["missing"].append(describe(f.name, f.schema, argtypes))
+            continue
+        matched.add(match)
+        *_, db_rettype, db_retset, source = found[match]
+        if source != f.source or (db_rettype, db_retset) != (normalized.get(f.rettype), f.retset):
+            result["stale"].append(describe(f.name, f.schema, argtypes))
+
+    # Only functions of the names (and schemas) flush creates functions in can be orphans
+    names = {(f.schema, f.name) for f in expected}
+    for i, (schema, name, visible, db_argtypes, *_) in enumerate(found):
+        if i not in matched and ((schema, name) in names or (visible and (None, name) in names)):
+            result["orphaned"].append(describe(name, schema, db_argtypes))
+    return result
+
+
+_TRIGGER_EVENTS = ("INSERT", "UPDATE", "DELETE", "TRUNCATE")
+
+
+def _check_trigger(args: _TriggerArgs) -> None:
+    if not args["table"]:
+        raise ValueError("plpy_trigger needs the table the trigger is created on.")
+    events = [event.upper() for event in args["events"]]
+    if not events or any(event not in _TRIGGER_EVENTS for event in events):
+        raise ValueError(f"events must be some of {_TRIGGER_EVENTS}, not {args['events']!r}")
+    if args["new_table"] or args["old_table"]:
+        if len(events) != 1:
+            raise ValueError("Transition tables can only be used by triggers with a single event.")
+        if args["new_table"] and events[0] not in ("INSERT", "UPDATE"):
+            raise ValueError(f"{events[0]} triggers do not have a NEW TABLE.")
+        if args["old_table"] and events[0] not in ("UPDATE", "DELETE"):
+            raise ValueError(f"{events[0]} triggers do not have an OLD TABLE.")
+
+
+def _trigger_to_sql(
+    func: Callable[..., Any],
+    table: str,
+    events: Sequence[str],
+    new_table: Optional[str] = None,
+    old_table: Optional[str] = None,
+    lazy_gd: bool = False,
+    gd_version: str = "",
+    packages: Sequence[str] = (),
+    data: Optional[Mapping[str, str]] = None,
+) -> text:
+    name = func.__name__
+    if func.__code__.co_argcount:
+        raise ValueError(f"{name} is a trigger function and can not take arguments.")
+    sql = str(
+        _to_sql(
+            func,
+            rettype="trigger",
+            lazy_gd=lazy_gd,
+            gd_version=gd_version,
+            packages=packages,
+            data=data,
+        )
+    )
+    sql += f"DROP TRIGGER IF EXISTS {name} ON {table};\n"
+    sql += f"CREATE TRIGGER {name}\n"
+    sql += f"  AFTER {' OR '.join(event.upper() for event in events)} ON {table}\n"
+    transition_tables = []
+    if new_table:
+        transition_tables.append(f"NEW TABLE AS {new_table}")
+    if old_table:
+        transition_tables.append(f"OLD TABLE AS {old_table}")
+    if transition_tables:
+        sql += f"  REFERENCING {' '.join(transition_tables)}\n"
+    sql += "  FOR EACH STATEMENT\n"
+    sql += f"  EXECUTE FUNCTION {name}();\n"
+    return text(sql)
+
+
+def _aggregate_to_sql(
+    cls: type,
+    parallel: Optional[str] = None,
+    lazy_gd: bool = False,
+    gd_version: str = "",
+    packages: Sequence[str] = (),
+    data: Optional[Mapping[str, str]] = None,
+) -> text:
+    name = cls.__name__
+    step = getattr(cls, "step", None)
+    if step is None:
+        raise ValueError(f"{name} does not have a step method and can not be an aggregate.")
+    step_parts = _inspect_function(step)
+    args = step_parts["args"]
+    annotations = step_parts["annotations"]
+    if not args:
+        raise ValueError(f"{name}.step must take the state followed by the aggregate's arguments.")
+    if any(arg not in annotations for arg in args) or "return" not in annotations:
+        raise ValueError(
+            f"{name}.step is not fully type annotated. "
+            f"The aggregate's argument and state types come from its annotations."
+        )
+    argtypes = [_map_type(annotations[arg]) for arg in args[1:]]
+    state_type = _map_type(annotations["return"])
+
+    options: Dict[str, Any] = {
+        "parallel": parallel,
+        "lazy_gd": lazy_gd,
+        "gd_version": gd_version,
+        "packages": packages,
+        "data": data,
+    }
+    sql = str(_to_sql(step, name=f"{name}_step", **options))
+    clauses = [f"SFUNC = {name}_step", f"STYPE = {state_type}"]
+    final = getattr(cls, "final", None)
+    if final is not None:
+        sql += str(_to_sql(final, name=f"{name}_final", **options))
+        clauses.append(f"FINALFUNC = {name}_final")
+    combine = getattr(cls, "combine", None)
+    if combine is not None:
+        # When one of the partial states is NULL, Postgres keeps the other without the call
+        sql += str(_to_sql(combine, name=f"{name}_combine", strict=True, **options))
+        clauses.append(f"COMBINEFUNC = {name}_combine")
+    initcond = getattr(cls, "initcond", None)
+    if initcond is not None:
+        escaped = str(initcond).replace("'", "''")
+        clauses.append(f"INITCOND = '{escaped}'")
+    if parallel:
+        clauses.append(f"PARALLEL = {parallel.upper()}")
+
+    sql += f"CREATE OR REPLACE AGGREGATE {name} ({', '.join(argtypes) or '*'}) (\n"
+    sql += ",\n".join(f"  {clause}" for clause in clauses)
+    sql += "\n);\n"
+    return text(sql)
+
+
+def _batch_body(name: str, args: Sequence[str], body: str, strict: bool) -> str:
+    """
+    The body of a function's batched variant:
+    the function is defined once and applied to the elements of its array arguments.
+    """
+    arg_list = ", ".join(args)
+    call = f"None if None in row else {name}(*row)" if strict else f"{name}(*row)"
+    lines = [f"def {name}({arg_list}):", textwrap.indent(body, "    ")]
+    if len(args) > 1:
+        lengths = ", ".join(f"len({arg})" for arg in args)
+        lines.append(f"if len({{{lengths}}}) != 1:")
+        lines.append(f'    plpy.error("{name}_batch: the arrays have different lengths")')
+    lines.append(f"return [{call} for row in zip({arg_list})]")
+    return "\n".join(lines)
+
+
+# Type annotations of arrays
+_ARRAY_ORIGINS = (list, collections.abc.Sequence)
+
+# Postgresql element types of numpy dtypes (by name, so numpy is never imported)
+_numpy_types = {
+    "float64": "float8",
+    "float32": "float4",
+    "int64": "int8",
+    "int32": "int4",
+    "int16": "int2",
+    "bool": "bool",
+}
+
+
+def _ndarray_dtype(annotation: Any) -> Optional[str]:
+    """
+    The dtype of a numpy.ndarray (or numpy.typing.NDArray) annotation, if it is one.
+    Arrays without a dtype are float64.
+    numpy is only looked up if it was imported already; otherwise no annotation can be an ndarray.
+    """
+    numpy = sys.modules.get("numpy")
+    if numpy is None:
+        return None
+    if annotation is numpy.ndarray:
+        return "float64"
+    if typing.get_origin(annotation) is not numpy.ndarray:
+        return None
+    args = typing.get_args(annotation)
+    scalars = typing.get_args(args[1]) if len(args) > 1 else ()
+    if not scalars or not isinstance(scalars[0], type):
+        return "float64"
+    # The scalar types' names vary between numpy versions (bool_ is bool in numpy 2)
+    dtype: str = numpy.dtype(scalars[0]).name
+    if dtype not in _numpy_types:
+        raise KeyError(f"numpy arrays of {dtype} could not be coerced to a Postgresql type.")
+    return dtype
+
 
-    return text("".join(s))
+def _with_ndarray_conversions(args: Sequence[str], annotations: Dict[str, Any], body: str) -> str:
+    """
+    Converts a function's array arguments annotated as numpy.ndarray from lists into ndarrays
+    and, if its return value is annotated as one, the ndarray it returns back into a list.
+    """
+    conversions = []
+    for arg in args:
+        dtype = _ndarray_dtype(annotations.get(arg))
+        if dtype:
+            # Arguments are globals in PlPython, so they can only be reassigned as globals
+            conversions.append(
+                f"global {arg}\n"
+                f"if {arg} is not None:\n"
+                f'    {arg} = numpy.asarray({arg}, dtype="{dtype}")\n'
+            )
+    if _ndarray_dtype(annotations.get("return")):
+        body = (
+            f"def {_NDARRAY_BODY}():\n"
+            f"{textwrap.indent(body, '    ')}\n"
+            f"result = {_NDARRAY_BODY}()\n"
+            f"return None if result is None else numpy.asarray(result).tolist()"
+        )
+    elif not conversions:
+        return body
+    return "import numpy\n" + "".join(conversions) + body
+
+
+_NDARRAY_BODY = "__plpy_man_body"
+
+
+def _map_type(annotation: Any) -> str:
+    """ The Postgresql type of a type annotation """
+    if typing.get_origin(annotation) in _ARRAY_ORIGINS:
+        return f"{_map_type(typing.get_args(annotation)[0])}[]"
+    dtype = _ndarray_dtype(annotation)
+    if dtype:
+        return f"{_numpy_types[dtype]}[]"
+    try:
+        return str(_type_map[annotation])
+    except (KeyError, TypeError) as err:
+        raise KeyError(
+            f"{annotation} could not be coerced to a Postgresql type. "
+            f"Try passing the SQLAlchemy type (or a string literal) to plpy_func instead."
+        ) from err
+
+
+# Return annotations of functions that return (or yield) a set of rows
+_SET_ORIGINS = (collections.abc.Iterator, collections.abc.Iterable, collections.abc.Generator)
+
+
+def _map_return_type(annotation: Any) -> str:
+    """
+    The Postgresql return type of a return annotation.
+
+    Iterators of scalars return a SETOF the scalar's type.
+    Iterators of NamedTuples or Tuples return a TABLE whose columns are the tuple's fields
+    (named column1, column2, ... for plain tuples, as in a VALUES list).
+    """
+    if typing.get_origin(annotation) not in _SET_ORIGINS:
+        return _map_type(annotation)
+    row = typing.get_args(annotation)[0]
+    if isinstance(row, type) and issubclass(row, tuple) and hasattr(row, "_fields"):
+        hints = typing.get_type_hints(row)
+        columns = [(field, _map_type(hints[field])) for field in row._fields]
+    elif typing.get_origin(row) is tuple:
+        fields = typing.get_args(row)
+        if Ellipsis in fields:
+            raise KeyError(f"{row} does not have a fixed number of columns.")
+        columns = [(f"column{i}", _map_type(field)) for i, field in enumerate(fields, start=1)]
+    else:
+        return f"SETOF {_map_type(row)}"
+    return f"TABLE({', '.join(f'{column} {_type}' for column, _type in columns)})"
+
+
+def _returns_set(func: Callable[..., Any], rettype: Type_ = "") -> bool:
+    if rettype:
+        return _stringify_type(rettype).upper().startswith(("SETOF", "TABLE"))
+    return typing.get_origin(func.__annotations__.get("return")) in _SET_ORIGINS
+
+
+_VOLATILITIES = ("IMMUTABLE", "STABLE", "VOLATILE")
+_PARALLEL_SAFETIES = ("SAFE", "RESTRICTED", "UNSAFE")
+
+
+def _check_name(name: str) -> None:
+    """ Registered objects can't replace the functions plpy_man creates """
+    if name in (_GD_LOADER, _IMPORT_HOOK, _LOAD_DATA, _STATS_FUNCTION):
+        raise ValueError(f"{name} is the name of a function plpy_man creates; rename it.")
+
+
+def _check_attributes(volatility: Optional[str], parallel: Optional[str]) -> None:
+    if volatility and volatility.upper() not in _VOLATILITIES:
+        raise ValueError(f"volatility must be one of {_VOLATILITIES}, not {volatility!r}")
+    if parallel and parallel.upper() not in _PARALLEL_SAFETIES:
+        raise ValueError(f"parallel must be one of {_PARALLEL_SAFETIES}, not {parallel!r}")
+
+
+def _function_attributes(
+    volatility: Optional[str],
+    parallel: Optional[str],
+    strict: bool,
+    leakproof: bool,
+    cost: Optional[float],
+    rows: Optional[float],
+    config: Optional[Mapping[str, str]],
+) -> str:
+    """ The attributes following a function's LANGUAGE clause, in the order Postgres documents """
+    attributes = []
+    if volatility:
+        attributes.append(volatility.upper())
+    if leakproof:
+        attributes.append("LEAKPROOF")
+    if strict:
+        attributes.append("STRICT")
+    if parallel:
+        attributes.append(f"PARALLEL {parallel.upper()}")
+    if cost is not None:
+        attributes.append(f"COST {cost}")
+    if rows is not None:
+        attributes.append(f"ROWS {rows}")
+    for parameter, value in (config or {}).items():
+        attributes.append(f"SET {parameter} = {value}")
+    return "".join(f" {attribute}" for attribute in attributes)
+
+
+def _queries_database(body: str) -> bool:
+    """ Whether a function body calls plpy.execute or plpy.cursor """
+    for node in ast.walk(ast.parse(body)):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and isinstance(node.func.value, ast.Name)
+            and node.func.value.id == "plpy"
+            and node.func.attr in ("execute", "cursor")
+        ):
+            return True
+    return False
+
+
+# SD and GD key of the statistics recorded by instrumented functions
+_STATS = "__plpy_man_stats__"
+_STATS_FUNCTION = "plpy_man_stats"
+
+
+def _instrumented(name: str, body: str) -> str:
+    """
+    Wraps a function body to record its calls in SD (see PlpyMan.plpy_func's `instrument`).
+
+    The first call builds the body as a closure over a plpy whose query functions are timed
+    and stores it in SD, so later calls only pay for reading the clock.
+    Set-returning functions can return an iterator (e.g. a generator) whose rows are computed
+    while PlPython iterates it, after the function returned: the iterator is wrapped so that
+    the call is recorded, with the time taken by every row, once it is exhausted or dropped.
+    The statistics are also registered in GD, where plpy_man_stats reads them.
+    The body is nested in functions, so every name defined here is prefixed to keep
+    the body's globals (e.g. its arguments) from resolving to them.
+    """
+    return f"""\
+if "{_STATS}" not in SD:
+    import time as __plpy_man_time
+
+    __plpy_man_stats = {{"calls": 0, "total": 0.0, "max": 0.0, "spi": 0.0}}
+
+    def __plpy_man_timed(query):
+        def timed(*args, **kwargs):
+            start = __plpy_man_time.perf_counter()
+            try:
+                return query(*args, **kwargs)
+            finally:
+                __plpy_man_stats["spi"] += __plpy_man_time.perf_counter() - start
+
+        return timed
+
+    class __plpy_man_Plpy:
+        def __getattr__(self, attribute):
+            return getattr(plpy, attribute)
+
+    __plpy_man_plpy = __plpy_man_Plpy()
+    __plpy_man_plpy.execute = __plpy_man_timed(plpy.execute)
+    __plpy_man_plpy.prepare = __plpy_man_timed(plpy.prepare)
+    __plpy_man_plpy.cursor = __plpy_man_timed(plpy.cursor)
+
+    def __plpy_man_instrument(plpy):
+        def {name.rpartition(".")[2]}():
+{textwrap.indent(body, " " * 12)}
+
+        return {name.rpartition(".")[2]}
+
+    def __plpy_man_record(elapsed):
+        __plpy_man_stats["calls"] += 1
+        __plpy_man_stats["total"] += elapsed
+        if elapsed > __plpy_man_stats["max"]:
+            __plpy_man_stats["max"] = elapsed
+
+    def __plpy_man_iterate(rows, elapsed, clock=__plpy_man_time.perf_counter):
+        try:
+            while True:
+                start = clock()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += clock() - start
+                yield row
+        finally:
+            __plpy_man_record(elapsed)
+
+    def __plpy_man_call(body, clock=__plpy_man_time.perf_counter):
+        start = clock()
+        try:
+            result = body()
+        except BaseException:
+            __plpy_man_record(clock() - start)
+            raise
+        if hasattr(result, "__next__"):
+            return __plpy_man_iterate(result, clock() - start)
+        __plpy_man_record(clock() - start)
+        return result
+
+    SD["{_STATS}"] = (__plpy_man_call, __plpy_man_instrument(__plpy_man_plpy))
+    GD.setdefault("{_STATS}", {{}})["{name}"] = __plpy_man_stats
+__plpy_man_call, __plpy_man_body = SD["{_STATS}"]
+return __plpy_man_call(__plpy_man_body)"""
+
+
+def _write_stats_sql() -> text:
+    return text(
+        f"""\
+CREATE OR REPLACE FUNCTION {_STATS_FUNCTION}()
+  RETURNS TABLE(function_name TEXT, calls BIGINT, total_time FLOAT, max_time FLOAT, spi_time FLOAT)
+AS $$
+    for name, stats in sorted(GD.get("{_STATS}", {{}}).items()):
+        yield name, stats["calls"], stats["total"] * 1000, stats["max"] * 1000, stats["spi"] * 1000
+$$ LANGUAGE plpython3u;
+"""
+    )
+
+
+# Set in the globals of functions whose GD objects are inlined, once they are defined
+_INLINED = "__plpy_man_inlined__"
+
+
+def _inline_gd(name: str, args: Sequence[str], body: str, gd: Mapping[str, _GDArgs]) -> str:
+    """
+    Replaces a body's lookups of GD objects with the objects (see PlpyMan.plpy_func's `inline_gd`).
+
+    PlPython keeps a function's globals between calls, so the objects are defined as globals
+    the first time the function runs; later calls only check that a global is set.
+    The objects' own GD lookups are replaced too.
+    """
+    replaced, keys = _replace_gd_lookups(body, gd)
+    if not keys:
+        return body
+    while True:
+        analyzed = [gd[key]["obj"] for key in keys if gd[key]["dependencies"]]
+        source = [
+            s
+            for _, definitions in _gd_definitions([gd[k]["obj"] for k in keys], analyzed)
+            for s in definitions
+        ]
+        definitions, used = _replace_gd_lookups("\n".join(source), gd)
+        new_keys = [key for key in used if key not in keys]
+        if not new_keys:
+            break
+        # Objects used by the objects are defined first, in case they're used as they're defined
+        keys = new_keys + keys
+
+    defined = sorted(
+        {n for statement in ast.parse(definitions).body for n in _bound_names(statement)}
+    )
+    used_names = {n.id for n in ast.walk(ast.parse(body)) if isinstance(n, ast.Name)}
+    clashes = sorted((set(args) | used_names) & set(defined))
+    if clashes:
+        raise ValueError(
+            f"{name} can not inline its GD objects because it already uses "
+            f"{', '.join(clashes)}, which inlining them would define. Rename them in {name}."
+        )
+    return (
+        f"global {', '.join(defined + [_INLINED])}\n"
+        f"try:\n"
+        f"    {_INLINED}\n"
+        f"except NameError:\n"
+        f"{textwrap.indent(definitions, '    ')}\n"
+        f"    {_INLINED} = True\n"
+        f"{replaced}"
+    )
+
+
+def _replace_gd_lookups(source: str, gd: Mapping[str, Any]) -> Tuple[str, List[str]]:
+    """ Replaces `GD["name"]` with `name` for the names in gd and returns the names replaced """
+    lookups = _gd_lookups(source, gd)
+    # AST offsets are in bytes
+    lines = source.encode().splitlines(keepends=True)
+    starts = [0]
+    for line in lines:
+        starts.append(starts[-1] + len(line))
+    encoded = source.encode()
+    for node, key in reversed(lookups):
+        start = starts[node.lineno - 1] + node.col_offset
+        end = starts[node.end_lineno - 1] + node.end_col_offset  # type: ignore
+        encoded = encoded[:start] + key.encode() + encoded[end:]
+    return encoded.decode(), list(dict.fromkeys(key for _, key in lookups))
+
+
+def _gd_lookups(source: str, names: Container[str]) -> List[Tuple[ast.Subscript, str]]:
+    """ The `GD["name"]` lookups of the names in source, in the order they appear """
+    lookups: List[Tuple[ast.Subscript, str]] = []
+    for node in ast.walk(ast.parse(source)):
+        if not (
+            isinstance(node, ast.Subscript)
+            and isinstance(node.value, ast.Name)
+            and node.value.id == "GD"
+            and isinstance(node.ctx, ast.Load)
+        ):
+            continue
+        key: Optional[ast.AST] = node.slice
+        if not isinstance(key, ast.Constant):  # Python 3.8 wraps the key in ast.Index
+            key = getattr(key, "value", None)
+        if isinstance(key, ast.Constant) and isinstance(key.value, str) and key.value in names:
+            lookups.append((node, key.value))
+    lookups.sort(key=lambda lookup: (lookup[0].lineno, lookup[0].col_offset))
+    return lookups
+
+
+def _package_modules(package: ModuleType) -> Dict[str, Tuple[str, bool]]:
+    """ The source file of a module or of every module of a package, and whether it's a package """
+    path = getattr(package, "__file__", None)
+    if not path or not path.endswith(".py"):
+        raise ValueError(
+            f"{package.__name__} can not be uploaded. Only modules and packages written in Python "
+            f"(with an __init__.py) can be imported from the database."
+        )
+    if not hasattr(package, "__path__"):
+        return {package.__name__: (path, False)}
+    modules = {}
+    root = os.path.dirname(path)
+    for directory, subdirectories, files in os.walk(root):
+        # Directories without an __init__.py are not (regular) packages
+        subdirectories[:] = sorted(
+            d for d in subdirectories if os.path.isfile(os.path.join(directory, d, "__init__.py"))
+        )
+        relative = os.path.relpath(directory, root)
+        prefix = package.__name__ if relative == "." else f"{package.__name__}.{relative}"
+        prefix = prefix.replace(os.sep, ".")
+        for file in sorted(files):
+            if file == "__init__.py":
+                modules[prefix] = (os.path.join(directory, file), True)
+            elif file.endswith(".py"):
+                modules[f"{prefix}.{file[:-3]}"] = (os.path.join(directory, file), False)
+    return modules
+
+
+def _package_to_sql(package: ModuleType) -> text:
+    """ Replaces the rows of a package's modules (see PlpyMan.to_package) """
+    name = package.__name__
+    sql = f"CREATE TABLE IF NOT EXISTS {_MODULES} (\n"
+    sql += "  name TEXT PRIMARY KEY, is_package BOOLEAN NOT NULL, source BYTEA NOT NULL\n"
+    sql += ");\n"
+    sql += f"DELETE FROM {_MODULES} WHERE name = '{name}' OR starts_with(name, '{name}.');\n"
+    # Parents that were not uploaded are uploaded as empty packages, so the package can be imported
+    parents = name.split(".")[:-1]
+    if parents:
+        rows = [f"('{'.'.join(parents[:i])}', TRUE, '')" for i in range(1, len(parents) + 1)]
+        sql += f"INSERT INTO {_MODULES} (name, is_package, source)\nVALUES\n"
+        sql += ",\n".join(f"  {row}" for row in rows)
+        sql += "\nON CONFLICT (name) DO NOTHING;\n"
+    rows = []
+    for module, (path, is_package) in _package_modules(package).items():
+        with open(path, "rb") as f:
+            source = base64.b64encode(f.read()).decode()
+        rows.append(f"('{module}', {str(is_package).upper()}, decode('{source}', 'base64'))")
+    sql += f"INSERT INTO {_MODULES} (name, is_package, source)\nVALUES\n"
+    sql += ",\n".join(f"  {row}" for row in rows)
+    sql += ";\n"
+    return text(sql)
+
+
+def _write_import_hook_sql() -> text:
+    """
+    The function installing the finder that imports modules from the modules table.
+    The finder comes last in sys.meta_path, so modules installed in the database's Python
+    take precedence, and it queries the table when a module isn't found anywhere else.
+    """
+    return text(
+        f"""\
+CREATE OR REPLACE FUNCTION {_IMPORT_HOOK}()
+RETURNS VOID AS $$
+    import importlib.abc
+    import importlib.util
+    import sys
+
+    class PlpyManFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+        def __init__(self):
+            self.plan = plpy.prepare(
+                "SELECT is_package, source FROM {_MODULES} WHERE name = $1", ["text"]
+            )
+
+        def find_spec(self, fullname, path, target=None):
+            rows = plpy.execute(self.plan, [fullname])
+            if not rows:
+                return None
+            spec = importlib.util.spec_from_loader(
+                fullname, self, origin=f"<{_MODULES}:{{fullname}}>",
+                is_package=rows[0]["is_package"],
+            )
+            spec.loader_state = rows[0]["source"]
+            return spec
+
+        def create_module(self, spec):
+            return None
+
+        def exec_module(self, module):
+            spec = module.__spec__
+            exec(compile(spec.loader_state, spec.origin, "exec"), module.__dict__)
+
+    if "{_FINDER}" not in GD:
+        GD["{_FINDER}"] = PlpyManFinder()
+        sys.meta_path.append(GD["{_FINDER}"])
+$$ LANGUAGE plpython3u;
+"""
+    )
+
+
+# Installs the finder of uploaded modules in backends that haven't installed it yet
+_IMPORT_HOOK_PROLOGUE = f'if "{_FINDER}" not in GD:\n    plpy.execute("SELECT {_IMPORT_HOOK}()")\n'
+
+
+def _imports_packages(source: str, packages: Sequence[str]) -> bool:
+    """ Whether source imports one of the packages (or one of their modules) """
+    if not packages:
+        return False
+    imported: List[str] = []
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            imported.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level and node.module:
+            # The names imported from a package may be its modules
+            imported.extend(f"{node.module}.{alias.name}" for alias in node.names)
+    return any(
+        module == package or module.startswith(f"{package}.")
+        for module in imported
+        for package in packages
+    )
+
+
+def _serialize(args: _GDDataArgs) -> bytes:
+    data = args["serializer"].dumps(args["obj"])
+    return data.encode() if isinstance(data, str) else data
+
+
+def _check_data_size(name: str, size: int, size_limit: int) -> None:
+    if size > size_limit:
+        warnings.warn(
+            f"The GD data {name} is {size / 1024 / 1024:.1f} MiB serialized, "
+            f"more than its size_limit of {size_limit / 1024 / 1024:.1f} MiB. "
+            f"Every backend that uses it holds its own copy; "
+            f"consider querying it from a table instead.",
+            stacklevel=4,
+        )
+
+
+def _data_to_sql(name: str, serializer: str, version: str, data: bytes) -> text:
+    """ Stores an object serialized for PlpyMan.to_gd_data """
+    encoded = base64.b64encode(data).decode()
+    return text(
+        f"""\
+CREATE TABLE IF NOT EXISTS {_DATA} (
+  name TEXT PRIMARY KEY, serializer TEXT NOT NULL, version TEXT NOT NULL, data BYTEA NOT NULL
+);
+INSERT INTO {_DATA} (name, serializer, version, data)
+VALUES ('{name}', '{serializer}', '{version}', decode('{encoded}', 'base64'))
+ON CONFLICT (name) DO UPDATE
+SET serializer = excluded.serializer, version = excluded.version, data = excluded.data;
+"""
+    )
+
+
+def _write_load_data_sql() -> text:
+    return text(
+        f"""\
+CREATE OR REPLACE FUNCTION {_LOAD_DATA}(VARIADIC names TEXT[])
+RETURNS VOID AS $$
+    import importlib
+
+    versions = GD.setdefault("{_DATA_VERSIONS}", {{}})
+    plan = plpy.prepare(
+        "SELECT name, serializer, version, data FROM {_DATA} WHERE name = ANY($1)", ["text[]"]
+    )
+    for row in plpy.execute(plan, [names]):
+        serializer = importlib.import_module(row["serializer"])
+        GD[row["name"]] = serializer.loads(row["data"])
+        versions[row["name"]] = row["version"]
+$$ LANGUAGE plpython3u;
+"""
+    )
+
+
+def _with_prologues(body: str, packages: Sequence[str], data: Mapping[str, str]) -> str:
+    """ Prefixes a body with the prologues its imports of packages and GD data lookups need """
+    names = list(dict.fromkeys(key for _, key in _gd_lookups(body, data))) if data else []
+    if names:
+        loaded = "__plpy_man_loaded"  # Prefixed, as the body's globals include its arguments
+        checks = " or ".join(f'{loaded}.get("{name}") != "{data[name]}"' for name in names)
+        arguments = ", ".join(f"'{name}'" for name in names)
+        body = (
+            f'{loaded} = GD.get("{_DATA_VERSIONS}", {{}})\n'
+            f"if {checks}:\n"
+            f'    plpy.execute("SELECT {_LOAD_DATA}({arguments})")\n'
+            f"{body}"
+        )
+    if _imports_packages(body, packages):
+        body = _IMPORT_HOOK_PROLOGUE + body
+    return body
+
+
+def _lazy_gd_prologue(gd_version: str) -> str:
+    """ Python that runs the GD loader once per backend (or whenever the GD version changes) """
+    if gd_version:
+        condition = f'GD.get("{_GD_VERSION}") != "{gd_version}"'
+    else:
+        condition = f'"{_GD_VERSION}" not in GD'
+    return f'if {condition}:\n    plpy.execute("SELECT {_GD_LOADER}()")\n'
 
 
 def _stringify_type(_type: Type_) -> str:
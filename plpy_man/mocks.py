@@ -1,6 +1,6 @@
 __all__ = ["SD", "GD", "TD", "plpy", "PLyPlan", "PLyResult", "PLyEnviron"]
 import enum
-from typing import Dict, TypedDict, Sequence, Any, Literal, ContextManager, Union
+from typing import Dict, List, TypedDict, Sequence, Any, Literal, ContextManager, Union
 from unittest.mock import MagicMock
 
 # https://www.postgresql.org/docs/13/plpython-sharing.html
@@ -16,6 +16,7 @@ class _TriggerDict(TypedDict):
     new: Dict
     old: Dict
     name: str
+    table_name: str
     table_schema: Any
     relid: str
     args: Any
@@ -61,11 +62,23 @@ class PLyCursor:
 
 
 class PLyPlan:
+    """ Mocked plan returned by plpy.prepare. Records the arguments it is executed with. """
+
+    def __init__(self, query: str = "", argtypes: Sequence[str] = ()) -> None:
+        self.query = query
+        self.argtypes = list(argtypes)
+        self.executions: List[List[Any]] = []
+
     def cursor(self, *args: Any) -> PLyCursor:
         ...
 
-    def execute(self, *args: Any) -> PLyResult:
-        ...
+    def execute(self, args: Sequence[Any] = (), limit: int = 0) -> PLyResult:
+        if len(args) != len(self.argtypes):
+            raise TypeError(
+                f"Expected sequence of {len(self.argtypes)} arguments, got {len(args)}: {args}"
+            )
+        self.executions.append(list(args))
+        return PLyResult()
 
     def status(self, *args: Any) -> int:
         ...
@@ -75,13 +88,16 @@ class PLyPlan:
 class plpy:
     """ Mocked plpy class that is automatically imported by methods on Plpy"""
 
-    def execute(self, query: Union[PLyPlan, str], *args: Any) -> PLyResult:
+    @staticmethod
+    def execute(query: Union[PLyPlan, str], *args: Any) -> PLyResult:
         ...
 
-    def prepare(self, query: str, *args: Any) -> PLyPlan:
-        ...
+    @staticmethod
+    def prepare(query: str, argtypes: Sequence[str] = ()) -> PLyPlan:
+        return PLyPlan(query, argtypes)
 
-    def cursor(self, query: Union[PLyPlan, str], *args: Any) -> PLyCursor:
+    @staticmethod
+    def cursor(query: Union[PLyPlan, str], *args: Any) -> PLyCursor:
         ...
 
     class SPIError(BaseException):
@@ -8,18 +8,20 @@ from sqlalchemy.engine import Engine
 from sqlalchemy.orm import relationship, sessionmaker, declarative_base
 
 
-def create_test_engine() -> Engine:
-    return _create_engine(
-        f"postgresql+psycopg2://{os.getenv('POSTGRES_USER')}:"
+def database_url(driver: str = "psycopg2") -> str:
+    return (
+        f"postgresql+{driver}://{os.getenv('POSTGRES_USER')}:"
         f"{os.getenv('POSTGRES_PASSWORD')}@"
         f"{os.getenv('POSTGRES_SERVER')}:"
         f"{os.getenv('POSTGRES_PORT')}/"
-        f"{os.getenv('POSTGRES_DB')}",
-        future=True,
-        echo=True,
+        f"{os.getenv('POSTGRES_DB')}"
     )
 
 
+def create_test_engine() -> Engine:
+    return _create_engine(database_url(), future=True, echo=True)
+
+
 @pytest.fixture
 def db() -> Generator:
     engine = create_test_engine()
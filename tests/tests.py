@@ -1,11 +1,30 @@
+import asyncio
+import base64
+import importlib.util
+import json
 import logging
+import marshal
+import os
+import re
+import subprocess
+import sys
 import textwrap
+import time
+import warnings
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple
 
 import pytest
-from sqlalchemy import text
+from sqlalchemy import Integer, create_engine, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
 
 import plpy_man
-from plpy_man.manager import _to_sql
+from plpy_man.__main__ import main as cli
+from plpy_man.emulator import Emulator
+from plpy_man.manager import _aggregate_to_sql, _prep_gd_script, _to_sql
+from .conftest import database_url
 
 
 logging.basicConfig(level=logging.INFO)
@@ -349,5 +368,1858 @@ def test_working_example(db):
 
 
 # fmt: on
+class TestIncrementalFlush:
+    def test_compile_keys(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        def helper():
+            pass
+
+        def answer() -> int:
+            return 42
+
+        manager.to_gd(helper)
+        manager.plpy_func(answer)
+        statements = compile_sql(manager)
+        assert list(statements) == ["_add_to_gd", "answer"]
+        assert statements["answer"] == _to_sql(answer).__str__()
+
+    def test_skips_unchanged(self, db) -> None:
+        def register(manager):
+            @manager.plpy_func
+            def incremental_answer() -> int:
+                return 42
+
+        manager = plpy_man.PlpyMan()
+        register(manager)
+        manager.flush(db, incremental=True)
+        first = dict(db.execute(text("SELECT name, hash FROM plpy_man_catalog")).all())
+
+        register(manager)
+        assert compile_sql(manager).keys() == first.keys()
+        manager.flush(db, incremental=True)
+        second = dict(db.execute(text("SELECT name, hash FROM plpy_man_catalog")).all())
+        assert first == second
+
+        actual = db.execute(text("SELECT incremental_answer()")).one()
+        assert actual == (42,)
+
+
+class TestBatchedFlush:
+    def test_batched(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+
+        def batched_one() -> int:
+            return 1
+
+        def batched_two() -> int:
+            return 2
+
+        def batched_three() -> int:
+            return 3
+
+        for func in (batched_one, batched_two, batched_three):
+            manager.plpy_func(func)
+        manager.flush(db, batched=True, chunk_size=2)
+
+        actual = db.execute(text("SELECT batched_one(), batched_two(), batched_three()")).one()
+        assert actual == (1, 2, 3)
+
+    def test_rollback(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+
+        def batched_ok() -> int:
+            return 1
+
+        def batched_broken():
+            return 1
+
+        manager.plpy_func(batched_ok)
+        manager.plpy_func(batched_broken, argtypes=[], rettype="no_such_type")
+        with pytest.raises(DBAPIError):
+            manager.flush(db, batched=True)
+
+        actual = db.execute(text("SELECT to_regproc('batched_ok')")).one()
+        assert actual == (None,)
+
+    def test_invalid_chunk_size(self) -> None:
+        with pytest.raises(ValueError):
+            plpy_man.PlpyMan().flush(None, batched=True, chunk_size=0)
+
+
+class TestLazyGD:
+    def test_prologue(self) -> None:
+        def lazy(name: str) -> str:
+            return GD["greet"](name)
+
+        actual = _to_sql(lazy, lazy_gd=True, gd_version="abc").__str__()
+        expected = """\
+CREATE OR REPLACE FUNCTION lazy (name VARCHAR)
+  RETURNS VARCHAR
+AS $$
+    if GD.get("__plpy_man_version__") != "abc":
+        plpy.execute("SELECT _add_to_gd()")
+    return GD["greet"](name)
+$$ LANGUAGE plpython3u;
+"""
+        assert actual == expected
+
+    def test_decorator_options(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func(lazy_gd=True)
+        def lazy() -> int:
+            return 1
+
+        assert manager._registered_funcs()[0]["lazy_gd"] is True
+        with pytest.raises(TypeError):
+            lazy()
+
+    def test_new_backend(self, db) -> None:
+        from plpy_man.mocks import GD
+
+        manager = plpy_man.PlpyMan()
+
+        def lazy_greeting(n):
+            return f"Hello, {n}"
+
+        manager.to_gd(lazy_greeting)
+
+        @manager.plpy_func(lazy_gd=True)
+        def lazy_greet(name: str) -> str:
+            return GD["lazy_greeting"](name)
+
+        manager.flush(db)
+        db.close()
+        engine = db.get_bind()
+        engine.dispose()  # The next connection is served by a backend with an empty GD
+        with engine.connect() as conn:
+            actual = conn.execute(text("SELECT lazy_greet('World')")).one()
+        assert actual == ("Hello, World",)
+
+
+class TestPrecompiledGD:
+    def test_bytecode(self) -> None:
+        script = 'GD["answer"] = 42\n'
+        sql = plpy_man.manager._write_bytecode_sql(script).__str__()
+        encoded = re.search(r"decode\('([^']+)', 'base64'\)", sql).group(1)
+        namespace = {"GD": {}}
+        exec(marshal.loads(base64.b64decode(encoded)), namespace)
+        assert namespace["GD"] == {"answer": 42}
+
+    def test_loader_falls_back_to_source(self) -> None:
+        sql = plpy_man.manager._write_gd_sql('GD["answer"] = 42\n', precompiled=True).__str__()
+        assert "marshal.loads" in sql
+        assert """exec('GD["answer"] = 42\\n', namespace)""" in sql
+
+    @staticmethod
+    def run_loader(magic, code) -> dict:
+        class Rows(list):
+            def nrows(self):
+                return len(self)
+
+        class Plpy:
+            @staticmethod
+            def execute(query):
+                return Rows([{"magic": magic, "code": code}])
+
+        loader = plpy_man.manager._precompiled_loader('GD["answer"] = 42\n')
+        gd = {}
+        exec(loader, {"GD": gd, "SD": {}, "plpy": Plpy})
+        return gd
+
+    def test_loader_runs_bytecode(self) -> None:
+        # The code object sets another answer than the source, telling which of them ran
+        code = marshal.dumps(compile('GD["answer"] = 43\n', "<test>", "exec"))
+        gd = self.run_loader(importlib.util.MAGIC_NUMBER.hex(), code)
+        assert gd == {"answer": 43, plpy_man.manager._GD_PRECOMPILED: True}
+
+    def test_loader_magic_mismatch(self) -> None:
+        gd = self.run_loader("0d0d0a00", b"not a code object")
+        assert gd == {"answer": 42, plpy_man.manager._GD_PRECOMPILED: False}
+
+    def test_precompiled_flush(self, db) -> None:
+        from plpy_man.mocks import GD
+
+        manager = plpy_man.PlpyMan()
+
+        def precompiled_double(n):
+            return n * 2
+
+        manager.to_gd(precompiled_double)
+
+        @manager.plpy_func
+        def call_precompiled(n: int) -> int:
+            return GD["precompiled_double"](n)
+
+        @manager.plpy_func
+        def loaded_precompiled() -> bool:
+            return GD["__plpy_man_precompiled__"]
+
+        @manager.plpy_func
+        def backend_magic() -> str:
+            import importlib.util
+
+            return importlib.util.MAGIC_NUMBER.hex()
+
+        manager.flush(db, precompile=True)
+        actual = db.execute(text("SELECT call_precompiled(21)")).one()
+        assert actual == (42,)
+        # The code object is only loaded by a backend running the same Python version
+        (magic,) = db.execute(text("SELECT backend_magic()")).one()
+        loaded = db.execute(text("SELECT loaded_precompiled()")).one()
+        assert loaded == (magic == importlib.util.MAGIC_NUMBER.hex(),)
+
+
+class TestSourceIndex:
+    def test_matches_inspect(self) -> None:
+        import inspect
+
+        def decorator(func):
+            return func
+
+        @decorator
+        def decorated(x):
+            """ docstring """
+            return x
+
+        class Class:
+            def method(self):
+                pass
+
+        # Python 3.8's inspect finds a nested class by its name alone, so it's only compared to
+        # functions and top-level classes
+        index = plpy_man.manager._SourceIndex()
+        for obj in (decorated, Class.method, test_null_none, Pair):
+            assert index.getsource(obj) == inspect.getsource(obj)
+        assert index.body(decorated) == plpy_man.manager._inspect_func_body(decorated)
+
+    def test_parses_once(self) -> None:
+        index = plpy_man.manager._SourceIndex()
+        index.body(test_null_none)
+        parsed = index._files[__file__]
+        index.body(test_arrays_lists)
+        assert index._files == {__file__: parsed}
+
+    def test_no_source_file(self) -> None:
+        namespace = {}
+        exec("def dynamic(): return 1", namespace)
+        assert plpy_man.manager._SourceIndex().body(namespace["dynamic"]) is None
+
+    def test_string_within_margin(self) -> None:
+        def query():
+            return """
+SELECT 1
+"""
+
+        assert plpy_man.manager._SourceIndex().body(query) is None
+        assert plpy_man.manager._get_func_body(query) == 'return """\nSELECT 1\n"""'
+
+
+class TestAsyncFlush:
+    def test_flush_async(self, db) -> None:
+        pytest.importorskip("asyncpg")
+        from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def async_answer() -> int:
+            return 42
+
+        async def flush_and_call():
+            engine = create_async_engine(database_url("asyncpg"))
+            try:
+                async with AsyncSession(engine) as session:
+                    await manager.flush_async(session, incremental=True)
+                    result = await session.execute(text("SELECT async_answer()"))
+                    return result.one()
+            finally:
+                await engine.dispose()
+
+        assert asyncio.run(flush_and_call()) == (42,)
+        assert manager._funcs == {}
+
+    def test_multi_statement_objects(self, db) -> None:
+        pytest.importorskip("asyncpg")
+        from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func(batched=True)
+        def async_triple(x: int) -> int:
+            return x * 3
+
+        async def flush_and_call():
+            engine = create_async_engine(database_url("asyncpg"))
+            try:
+                async with AsyncSession(engine) as session:
+                    await manager.flush_async(session, incremental=True, precompile=True)
+                    result = await session.execute(
+                        text("SELECT async_triple(2), async_triple_batch(ARRAY[1, 2])")
+                    )
+                    return result.one()
+            finally:
+                await engine.dispose()
+
+        assert asyncio.run(flush_and_call()) == (6, [3, 6])
+
+    def test_batched(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def async_answer() -> int:
+            return 42
+
+        with pytest.raises(ValueError, match="batched is not supported"):
+            asyncio.run(manager.flush_async(None, batched=True))
+        assert manager._funcs
+
+    def test_one_statement_per_step(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func(batched=True)
+        def async_triple(x: int) -> int:
+            return x * 3
+
+        statements = manager._compile(precompile=True)
+        assert len(statements["_add_to_gd:bytecode"]) == 2
+        assert len(statements["async_triple"]) == 2
+        steps = list(plpy_man.manager._flush_steps(statements, False, 1, split=True))
+        for statement, _ in steps:
+            assert len(plpy_man.manager._split_statements(str(statement))) == 1
+        assert len(steps) == 6
+
+    def test_split_statements(self) -> None:
+        sql = """\
+CREATE FUNCTION f() RETURNS TEXT AS $$
+return "a;b"
+$$ LANGUAGE plpython3u;
+INSERT INTO t (a, "b;") VALUES ('it''s; here') -- a comment;
+;
+"""
+        statements = plpy_man.manager._split_statements(sql)
+        assert "".join(statements) == sql
+        assert [s.strip()[:6] for s in statements] == ["CREATE", "INSERT"]
+
+
+class TestFlushMany:
+    def test_failing_target(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def fanned_out() -> int:
+            return 1
+
+        unreachable = create_engine("postgresql+psycopg2://nobody@127.0.0.1:1/nowhere")
+        results = manager.flush_many([unreachable, db], max_workers=2)
+
+        assert [result["target"] for result in results] == [unreachable, db]
+        assert isinstance(results[0]["error"], DBAPIError)
+        assert results[1]["error"] is None
+        assert all(result["seconds"] > 0 for result in results)
+        assert db.execute(text("SELECT fanned_out()")).one() == (1,)
+        # Failed targets can be retried because the registry is kept
+        assert manager.get("fanned_out")
+
+
+class TestLockedFlush:
+    def test_concurrent_workers(self, db) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        def worker(_):
+            manager = plpy_man.PlpyMan()
+
+            @manager.plpy_func
+            def locked_answer() -> int:
+                return 42
+
+            with Session(bind=db.get_bind()) as session:
+                manager.flush(session, lock=True)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(worker, range(8)))
+
+        assert db.execute(text("SELECT locked_answer()")).one() == (42,)
+        version = db.execute(
+            text("SELECT count(*) FROM plpy_man_catalog WHERE name = 'plpy_man:registry'")
+        ).one()
+        assert version == (1,)
+
+    def test_stored_version(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def versioned_answer() -> int:
+            return 42
+
+        read_version = plpy_man.manager._read_version_sql
+        params = {"name": plpy_man.manager._REGISTRY_VERSION}
+        assert db.execute(read_version("plpy_man_missing_catalog"), params).all() == []
+        with Session(bind=db.get_bind()) as session:
+            manager.flush(session, lock=True)
+        expected = db.execute(
+            text("SELECT hash FROM plpy_man_catalog WHERE name = :name"), params
+        ).scalar()
+        assert db.execute(read_version(), params).scalar() == expected
+
+    def test_up_to_date_skips_the_lock(self) -> None:
+        class Result(list):
+            def __init__(self, value=None):
+                super().__init__()
+                self.value = value
+
+            def scalar(self):
+                return self.value
+
+        def run(stored_version):
+            steps = plpy_man.manager._flush_steps(statements, False, 1, lock=True)
+            executed = [next(steps)]
+            try:
+                while True:
+                    executed.append(steps.send(Result(stored_version)))
+            except StopIteration:
+                return executed
+
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def locked_answer() -> int:
+            return 42
+
+        statements = manager._compile(precompile=False)
+        stale = run(None)
+        assert "pg_advisory_xact_lock" in str(stale[1][0])
+        version = stale[-1][1][-1]
+        assert version["name"] == "plpy_man:registry"
+
+        up_to_date = run(version["hash"])
+        assert len(up_to_date) == 1
+        assert "to_regclass" in str(up_to_date[0][0])
+
+    def test_no_wait(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def skipped_answer() -> int:
+            return 42
+
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": plpy_man.manager._LOCK_KEY})
+        with Session(bind=db.get_bind()) as session:
+            manager.flush(session, lock=True, wait=False)
+            actual = session.execute(text("SELECT to_regproc('skipped_answer')")).one()
+        db.rollback()
+        assert actual == (None,)
+
+
+class TestFunctionAttributes:
+    def test_attributes(self) -> None:
+        def pyadd(a: int, b: int) -> int:
+            return a + b
+
+        actual = _to_sql(
+            pyadd,
+            volatility="immutable",
+            parallel="safe",
+            strict=True,
+            leakproof=True,
+            cost=10,
+            config={"search_path": "public, pg_temp"},
+        ).__str__()
+        expected = """\
+CREATE OR REPLACE FUNCTION pyadd (a INTEGER, b INTEGER)
+  RETURNS INTEGER
+AS $$
+    return a + b
+$$ LANGUAGE plpython3u IMMUTABLE LEAKPROOF STRICT PARALLEL SAFE COST 10 \
+SET search_path = public, pg_temp;
+"""
+        assert actual == expected
+
+    def test_invalid_attribute(self) -> None:
+        with pytest.raises(ValueError):
+            plpy_man.PlpyMan().plpy_func(volatility="sometimes")
+
+    def test_immutable_query_warns(self) -> None:
+        def count_users() -> int:
+            return plpy.execute("SELECT count(*) AS n FROM users")[0]["n"]
+
+        with pytest.warns(UserWarning, match="IMMUTABLE"):
+            _to_sql(count_users, volatility="IMMUTABLE")
+
+    def test_stable_function(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func(volatility="STABLE", parallel="SAFE", cost=1)
+        def stable_answer() -> int:
+            return 42
+
+        manager.flush(db)
+        actual = db.execute(
+            text("SELECT provolatile, proparallel FROM pg_proc WHERE proname = 'stable_answer'")
+        ).one()
+        assert actual == ("s", "s")
+
+
+class Pair(NamedTuple):
+    name: str
+    value: int
+
+
+class TestSetReturningFunctions:
+    def test_setof(self) -> None:
+        def count_to(n: int) -> Iterator[int]:
+            for i in range(1, n + 1):
+                yield i
+
+        actual = _to_sql(count_to).__str__()
+        expected = """\
+CREATE OR REPLACE FUNCTION count_to (n INTEGER)
+  RETURNS SETOF INTEGER
+AS $$
+    for i in range(1, n + 1):
+        yield i
+$$ LANGUAGE plpython3u;
+"""
+        assert actual == expected
+
+    def test_named_tuple_table(self) -> None:
+        def pairs(n: int) -> Iterable[Pair]:
+            return (Pair(str(i), i) for i in range(n))
+
+        actual = _to_sql(pairs, rows=10).__str__()
+        expected = """\
+CREATE OR REPLACE FUNCTION pairs (n INTEGER)
+  RETURNS TABLE(name VARCHAR, value INTEGER)
+AS $$
+    return (Pair(str(i), i) for i in range(n))
+$$ LANGUAGE plpython3u ROWS 10;
+"""
+        assert actual == expected
+
+    def test_rows_of_a_scalar(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        with pytest.raises(ValueError, match="doesn't return a set"):
+
+            @manager.plpy_func(rows=10)
+            def one_row(n: int) -> int:
+                return n
+
+        with pytest.raises(ValueError, match="doesn't return a set"):
+            manager.plpy_func(lambda n: n, argtypes=[Integer], rettype=Integer, rows=10)
+
+        @manager.plpy_func(rows=10)
+        def some_rows(n: int) -> Iterator[int]:
+            return iter(range(n))
+
+        assert list(manager._funcs) == [(None, "some_rows")]
+
+    def test_tuple_table(self) -> None:
+        def enumerate_words(words: str) -> Iterator[Tuple[int, str]]:
+            yield from enumerate(words.split())
+
+        actual = _to_sql(enumerate_words).__str__()
+        assert "RETURNS TABLE(column1 INTEGER, column2 VARCHAR)" in actual
+
+    def test_streamed(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def streamed_squares(n: int) -> Iterator[Tuple[int, int]]:
+            for i in range(n):
+                yield i, i * i
+
+        manager.flush(db)
+        actual = db.execute(text("SELECT * FROM streamed_squares(3)")).all()
+        assert actual == [(0, 0), (1, 1), (2, 4)]
+
+
+class TestCachedExecute:
+    def test_plan_is_cached(self) -> None:
+        from plpy_man.helpers import cached_execute
+        from plpy_man.mocks import PLyPlan, PLyResult
+
+        SD = {}
+        query = "SELECT name FROM users WHERE id = $1"
+        assert isinstance(cached_execute(SD, query, ["int"], [1]), PLyResult)
+        cached_execute(SD, query, ["int"], [2])
+
+        (plan,) = SD.values()
+        assert isinstance(plan, PLyPlan)
+        assert (plan.query, plan.argtypes) == (query, ["int"])
+        assert plan.executions == [[1], [2]]
+
+    def test_wrong_number_of_arguments(self) -> None:
+        from plpy_man.helpers import cached_execute
+
+        with pytest.raises(TypeError):
+            cached_execute({}, "SELECT $1", ["int"], [])
+
+    def test_gd_script(self) -> None:
+        # The GD script defines the function without typing or the mocks imported
+        from plpy_man.helpers import cached_execute
+
+        GD = {}
+        exec(_prep_gd_script([cached_execute]), {"GD": GD})
+        assert GD["cached_execute"].__name__ == "cached_execute"
+
+    def test_in_database(self, db) -> None:
+        from plpy_man.helpers import cached_execute
+        from plpy_man.mocks import GD, SD
+
+        manager = plpy_man.PlpyMan()
+        manager.to_gd(cached_execute)
+
+        @manager.plpy_func
+        def cached_double(n: int) -> int:
+            return GD["cached_execute"](SD, "SELECT $1 * 2 AS n", ["int"], [n])[0]["n"]
+
+        manager.flush(db)
+        actual = db.execute(text("SELECT cached_double(1), cached_double(21)")).one()
+        assert actual == (2, 42)
+
+
+class TestBatchedVariants:
+    def test_batch_sql(self) -> None:
+        def pyadd(a: int, b: int) -> int:
+            return a + b
+
+        actual = _to_sql(pyadd, strict=True, batched=True).__str__()
+        expected = """\
+CREATE OR REPLACE FUNCTION pyadd (a INTEGER, b INTEGER)
+  RETURNS INTEGER
+AS $$
+    return a + b
+$$ LANGUAGE plpython3u STRICT;
+CREATE OR REPLACE FUNCTION pyadd_batch (a INTEGER[], b INTEGER[])
+  RETURNS INTEGER[]
+AS $$
+    def pyadd(a, b):
+        return a + b
+    if len({len(a), len(b)}) != 1:
+        plpy.error("pyadd_batch: the arrays have different lengths")
+    return [None if None in row else pyadd(*row) for row in zip(a, b)]
+$$ LANGUAGE plpython3u STRICT;
+"""
+        assert actual == expected
+
+    def test_array_annotations(self) -> None:
+        def total(xs: List[float]) -> float:
+            return sum(xs)
+
+        assert "(xs FLOAT[])" in _to_sql(total).__str__()
+
+    def test_not_batchable(self) -> None:
+        def count_to(n: int) -> Iterator[int]:
+            yield from range(n)
+
+        with pytest.raises(ValueError):
+            _to_sql(count_to, batched=True)
+
+    def test_batch_in_database(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func(batched=True)
+        def batched_square(x: int) -> int:
+            return x * x
+
+        manager.flush(db)
+        actual = db.execute(text("SELECT batched_square_batch(ARRAY[1, 2, 3])")).one()
+        assert actual == ([1, 4, 9],)
+
+
+class TestNumpyArrays:
+    def test_ndarray_sql(self) -> None:
+        np = pytest.importorskip("numpy")
+        npt = pytest.importorskip("numpy.typing")
+
+        def scale(x: npt.NDArray[np.float64], k: float) -> npt.NDArray[np.float64]:
+            return x * k
+
+        actual = _to_sql(scale).__str__()
+        expected = """\
+CREATE OR REPLACE FUNCTION scale (x float8[], k FLOAT)
+  RETURNS float8[]
+AS $$
+    import numpy
+    global x
+    if x is not None:
+        x = numpy.asarray(x, dtype="float64")
+    def __plpy_man_body():
+        return x * k
+    result = __plpy_man_body()
+    return None if result is None else numpy.asarray(result).tolist()
+$$ LANGUAGE plpython3u;
+"""
+        assert actual == expected
+
+    def test_dtypes(self) -> None:
+        np = pytest.importorskip("numpy")
+        npt = pytest.importorskip("numpy.typing")
+
+        def total(xs: npt.NDArray[np.int32], mask: np.ndarray) -> int:
+            return int(xs[mask > 0].sum())
+
+        actual = _to_sql(total).__str__()
+        assert "(xs int4[], mask float8[])" in actual
+        assert 'xs = numpy.asarray(xs, dtype="int32")' in actual
+        assert "__plpy_man_body" not in actual
+
+    def test_bool_dtype(self) -> None:
+        np = pytest.importorskip("numpy")
+        npt = pytest.importorskip("numpy.typing")
+
+        def count(flags: npt.NDArray[np.bool_]) -> int:
+            return int(flags.sum())
+
+        actual = _to_sql(count).__str__()
+        assert "(flags bool[])" in actual
+        assert 'flags = numpy.asarray(flags, dtype="bool")' in actual
+
+    def test_unsupported_dtype(self) -> None:
+        np = pytest.importorskip("numpy")
+        npt = pytest.importorskip("numpy.typing")
+
+        def first(xs: npt.NDArray[np.complex128]) -> float:
+            return xs[0].real
+
+        with pytest.raises(KeyError):
+            _to_sql(first)
+
+    def test_ndarray_in_database(self, db) -> None:
+        np = pytest.importorskip("numpy")
+        npt = pytest.importorskip("numpy.typing")
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def normalized(x: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+            return x / numpy.linalg.norm(x)
+
+        manager.flush(db)
+        actual = db.execute(text("SELECT normalized(ARRAY[3, 4]::float8[])")).one()
+        assert actual == ([0.6, 0.8],)
+
+
+class TestAggregates:
+    class py_sum:
+        @staticmethod
+        def step(state: float, x: float) -> float:
+            return x if state is None else state + x
+
+        @staticmethod
+        def combine(a: float, b: float) -> float:
+            return a + b
+
+    class py_avg:
+        initcond = "{0,0}"
+
+        @staticmethod
+        def step(state: List[float], x: float) -> List[float]:
+            return [state[0] + x, state[1] + 1]
+
+        @staticmethod
+        def final(state: List[float]) -> float:
+            return state[0] / state[1] if state[1] else None
+
+    def test_aggregate_sql(self) -> None:
+        actual = _aggregate_to_sql(self.py_sum, parallel="safe").__str__()
+        expected = """\
+CREATE OR REPLACE FUNCTION py_sum_step (state FLOAT, x FLOAT)
+  RETURNS FLOAT
+AS $$
+    return x if state is None else state + x
+$$ LANGUAGE plpython3u PARALLEL SAFE;
+CREATE OR REPLACE FUNCTION py_sum_combine (a FLOAT, b FLOAT)
+  RETURNS FLOAT
+AS $$
+    return a + b
+$$ LANGUAGE plpython3u STRICT PARALLEL SAFE;
+CREATE OR REPLACE AGGREGATE py_sum (FLOAT) (
+  SFUNC = py_sum_step,
+  STYPE = FLOAT,
+  COMBINEFUNC = py_sum_combine,
+  PARALLEL = SAFE
+);
+"""
+        assert actual == expected
+
+    def test_final_and_initcond(self) -> None:
+        actual = _aggregate_to_sql(self.py_avg).__str__()
+        assert "CREATE OR REPLACE FUNCTION py_avg_final (state FLOAT[])" in actual
+        assert "  FINALFUNC = py_avg_final,\n  INITCOND = '{0,0}'\n);" in actual
+
+    def test_requires_step(self) -> None:
+        class no_step:
+            pass
+
+        with pytest.raises(ValueError):
+            _aggregate_to_sql(no_step)
+
+    def test_class_is_returned(self) -> None:
+        manager = plpy_man.PlpyMan()
+        assert manager.plpy_aggregate(parallel="SAFE")(self.py_avg) is self.py_avg
+        assert self.py_avg.step([0, 0], 2.0) == [2.0, 1]
+
+    def test_aggregate_in_database(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+        manager.plpy_aggregate(self.py_avg)
+        manager.flush(db)
+        actual = db.execute(text("SELECT py_avg(x) FROM generate_series(1, 4) AS x")).one()
+        assert actual == (2.5,)
+
+
+class TestStatementTriggers:
+    def test_trigger_sql(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_trigger(table="orders", new_table="new_rows")
+        def count_orders() -> None:
+            plpy.execute("UPDATE order_count SET n = n + (SELECT count(*) FROM new_rows)")
+
+        actual = compile_sql(manager)["trigger:count_orders"]
+        expected = """\
+CREATE OR REPLACE FUNCTION count_orders()
+  RETURNS trigger
+AS $$
+    plpy.execute("UPDATE order_count SET n = n + (SELECT count(*) FROM new_rows)")
+$$ LANGUAGE plpython3u;
+DROP TRIGGER IF EXISTS count_orders ON orders;
+CREATE TRIGGER count_orders
+  AFTER INSERT ON orders
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT
+  EXECUTE FUNCTION count_orders();
+"""
+        assert actual == expected
+        with pytest.raises(TypeError):
+            count_orders()
+
+    def test_events_without_transition_tables(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_trigger(table="orders", events=("insert", "delete", "truncate"))
+        def orders_changed() -> None:
+            plpy.execute("NOTIFY orders_changed")
+
+        actual = compile_sql(manager)["trigger:orders_changed"]
+        assert "  AFTER INSERT OR DELETE OR TRUNCATE ON orders\n  FOR EACH STATEMENT\n" in actual
+
+    @pytest.mark.parametrize(
+        "options",
+        [
+            {"events": ("INSERT",)},
+            {"table": "t", "events": ("UPSERT",)},
+            {"table": "t", "events": ("INSERT", "UPDATE"), "new_table": "new_rows"},
+            {"table": "t", "events": ("DELETE",), "new_table": "new_rows"},
+            {"table": "t", "events": ("INSERT",), "old_table": "old_rows"},
+        ],
+    )
+    def test_invalid_triggers(self, options) -> None:
+        with pytest.raises(ValueError):
+            plpy_man.PlpyMan().plpy_trigger(**options)
+
+    def test_trigger_in_database(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+        db.execute(text("CREATE TABLE trigger_source (x INTEGER)"))
+        db.execute(text("CREATE TABLE trigger_target (total INTEGER)"))
+
+        @manager.plpy_trigger(table="trigger_source", new_table="new_rows")
+        def sum_inserted() -> None:
+            plpy.execute("INSERT INTO trigger_target SELECT sum(x) FROM new_rows")
+
+        manager.flush(db)
+        db.execute(text("INSERT INTO trigger_source SELECT generate_series(1, 100)"))
+        actual = db.execute(text("SELECT * FROM trigger_target")).all()
+        assert actual == [(5050,)]
+
+
+class TestEmulator:
+    def test_call(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        def double(x):
+            return x * 2
+
+        @manager.plpy_func
+        def count_calls(x: int) -> int:
+            SD["calls"] = SD.get("calls", 0) + 1
+            return GD["double"](x) + SD["calls"]
+
+        emulator = Emulator()
+        emulator.to_gd(double)
+        assert emulator.call(count_calls, 1) == 3
+        assert emulator.call(count_calls, x=1) == 4
+        assert emulator.GD["double"](2) == 4
+
+    def test_arguments_are_globals(self) -> None:
+        def increment(x: int) -> int:
+            x = x + 1
+            return x
+
+        def get_x(x: int) -> int:
+            return globals()["x"]
+
+        with pytest.raises(UnboundLocalError):
+            Emulator().call(increment, 1)
+        assert Emulator().call(get_x, 1) == 1
+
+    def test_errors_point_at_source(self) -> None:
+        def fail() -> None:
+            plpy.error("failed", 42)
+
+        with pytest.raises(Emulator().plpy.Error, match="failed 42") as exc_info:
+            Emulator().call(fail)
+        frame = exc_info.traceback[-2]
+        assert (frame.name, frame.path) == ("fail", Path(__file__))
+        assert frame.lineno + 1 == fail.__code__.co_firstlineno + 1
+
+    def test_line_numbers(self) -> None:
+        import inspect
+
+        def fail() -> None:
+            x = 1
+
+            # Comments and blank lines between statements aren't part of the body's statements
+
+            if x:
+                raise ValueError("failed")
+
+        lines, start = inspect.getsourcelines(fail)
+        raise_line = start + next(i for i, line in enumerate(lines) if "raise" in line)
+        with pytest.raises(ValueError) as exc_info:
+            Emulator().call(fail)
+        assert exc_info.traceback[-1].lineno + 1 == raise_line
+
+    def test_trigger_data(self) -> None:
+        def event() -> str:
+            return TD["event"]
+
+        assert Emulator().call(event, TD={"event": "INSERT"}) == "INSERT"
+
+    def test_transition_tables_need_table(self) -> None:
+        def count_rows() -> int:
+            return plpy.execute("SELECT count(*) AS n FROM new_rows")[0]["n"]
+
+        with pytest.raises(ValueError, match="table_name"):
+            Emulator().call(count_rows, transition_tables={"new_rows": []})
+
+    def test_transition_tables(self, db) -> None:
+        db.execute(text("CREATE TABLE emulated_source (x INTEGER, label TEXT)"))
+
+        def sum_inserted() -> int:
+            return plpy.execute("SELECT sum(x) AS total FROM new_rows")[0]["total"]
+
+        rows = [{"x": 1, "label": "a"}, {"x": 2}]
+        TD = {"event": "INSERT", "level": "STATEMENT", "table_name": "emulated_source"}
+        assert Emulator(db).call(sum_inserted, TD=TD, transition_tables={"new_rows": rows}) == 3
+        exists = db.execute(text("SELECT to_regclass('pg_temp.new_rows')")).scalar()
+        assert exists is None
+
+    def test_quoting(self) -> None:
+        plpy = Emulator().plpy
+        assert plpy.quote_literal("it's") == "'it''s'"
+        assert plpy.quote_literal("a\\b") == "E'a\\\\b'"
+        assert plpy.quote_nullable(None) == "NULL"
+        assert plpy.quote_ident("users") == "users"
+        assert plpy.quote_ident('My "Table"') == '"My ""Table"""'
+
+    def test_no_database(self) -> None:
+        def query() -> int:
+            return plpy.execute("SELECT 1")
+
+        with pytest.raises(RuntimeError):
+            Emulator().call(query)
+
+    def test_query(self, db) -> None:
+        def add(a: int, b: int) -> int:
+            plan = plpy.prepare("SELECT $1 + $2 AS total, '1:2'::text AS colon", ["int", "int"])
+            rows = plpy.execute(plan, [a, b])
+            return rows[0]["total"], rows.colnames(), rows.nrows()
+
+        assert Emulator(db).call(add, 1, 2) == (3, ["total", "colon"], 1)
+
+    def test_cursor(self, db) -> None:
+        def total() -> int:
+            cursor = plpy.cursor("SELECT generate_series(1, 10) AS x")
+            return sum(row["x"] for row in cursor.fetch(4)) + len(list(cursor))
+
+        assert Emulator(db).call(total) == 16
+
+
+def compile_sql(manager: plpy_man.PlpyMan) -> Dict[str, str]:
+    """ The SQL the manager would flush, with the statements of each object joined """
+    return {name: "".join(sql) for name, sql in manager._compile().items()}
+
+
+def compile_body(sql: str, GD: dict, plpy=None) -> Tuple[Callable, dict]:
+    """ Compiles a generated function body the way PlPython does, returning its globals """
+    body = sql.split("AS $$\n")[1].split("$$ LANGUAGE")[0]
+    namespace = {"GD": GD, "SD": {}, "plpy": plpy}
+    exec(f"def procedure():\n{body}", namespace)
+    return namespace["procedure"], namespace
+
+
+class TestInstrumentation:
+    def test_stats(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func(instrument=True)
+        def add_one(start: int) -> int:
+            plpy.execute("SELECT 1")
+            return start + 1
+
+        class Plpy:
+            def __init__(self):
+                self.queries: List[str] = []
+
+            def execute(self, query):
+                self.queries.append(query)
+
+            prepare = cursor = execute
+
+        statements = compile_sql(manager)
+        GD, plpy = {}, Plpy()
+        procedure, namespace = compile_body(statements["add_one"], GD, plpy)
+        results = []
+        for i in range(3):
+            namespace["start"] = i  # Arguments are globals
+            results.append(procedure())
+        assert results == [1, 2, 3]
+        assert plpy.queries == ["SELECT 1"] * 3
+        stats = GD["__plpy_man_stats__"]["add_one"]
+        assert stats["calls"] == 3
+        assert stats["total"] >= stats["max"] >= stats["spi"] / 3 > 0
+
+        stats_procedure, _ = compile_body(statements["plpy_man_stats"], GD, plpy)
+        rows = list(stats_procedure())
+        assert [row[:2] for row in rows] == [("add_one", 3)]
+
+    class SlowPlpy:
+        """ A plpy whose queries take 10 ms """
+
+        @staticmethod
+        def execute(query):
+            time.sleep(0.01)
+            return [{"x": 1}, {"x": 2}]
+
+        prepare = cursor = execute
+
+    def test_generator_body(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func(instrument=True)
+        def slow_numbers(n: int) -> Iterator[int]:
+            for i in range(n):
+                plpy.execute("SELECT 1")
+                yield i
+
+        GD = {}
+        procedure, namespace = compile_body(
+            compile_sql(manager)["slow_numbers"], GD, self.SlowPlpy
+        )
+        namespace["n"] = 3
+        rows = procedure()
+        stats = GD["__plpy_man_stats__"]["slow_numbers"]
+        assert stats["calls"] == 0  # Recorded once the rows have been iterated
+        assert list(rows) == [0, 1, 2]
+        assert stats["calls"] == 1
+        assert stats["total"] == stats["max"] >= stats["spi"] >= 0.03
+
+    def test_set_returning_iterator(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func(instrument=True)
+        def slow_rows() -> Iterator[Tuple[int, int]]:
+            rows = plpy.execute("SELECT 1")
+            return ((row["x"], plpy.execute("SELECT 1")[0]["x"]) for row in rows)
+
+        GD = {}
+        procedure, _ = compile_body(compile_sql(manager)["slow_rows"], GD, self.SlowPlpy)
+        assert list(procedure()) == [(1, 1), (2, 1)]
+        stats = GD["__plpy_man_stats__"]["slow_rows"]
+        assert stats["calls"] == 1
+        assert stats["total"] >= stats["spi"] >= 0.03
+
+    def test_disabled(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def add_one(start: int) -> int:
+            return start + 1
+
+        statements = compile_sql(manager)
+        assert "plpy_man_stats" not in statements
+        assert "__plpy_man_stats__" not in statements["add_one"]
+
+    def test_stats_in_database(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func(instrument=True)
+        def instrumented_sleep(seconds: float) -> int:
+            return plpy.execute(f"SELECT pg_sleep({seconds})").nrows()
+
+        manager.flush(db)
+        db.execute(text("SELECT instrumented_sleep(0.01) FROM generate_series(1, 3)")).all()
+        actual = db.execute(text("SELECT * FROM plpy_man_stats()")).one()
+        assert actual[:2] == ("instrumented_sleep", 3)
+        assert actual.spi_time >= 30
+
+
+def import_module(path, source: str):
+    """ Writes and imports a module """
+    path.write_text(textwrap.dedent(source))
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[path.stem] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestBundle:
+    def test_bundle_is_used(self, tmp_path) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def bundled() -> int:
+            return 1
+
+        bundle = tmp_path / "bundle.json"
+        manager.build(str(bundle))
+        contents = json.loads(bundle.read_text())
+        assert contents["statements"] == manager._compile()
+        # The bundled SQL is sent as it is
+        contents["statements"]["bundled"] = ["SELECT 'from the bundle'"]
+        bundle.write_text(json.dumps(contents))
+        manager.use_bundle(str(bundle))
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            assert manager._compile()["bundled"] == ["SELECT 'from the bundle'"]
+        manager.use_bundle(None)
+        assert manager._compile()["bundled"] != ["SELECT 'from the bundle'"]
+
+    def test_stale_registry(self, tmp_path) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def bundled() -> int:
+            return 1
+
+        bundle = str(tmp_path / "bundle.json")
+        manager.build(bundle)
+        manager.use_bundle(bundle)
+
+        @manager.plpy_func
+        def registered_later() -> int:
+            return 2
+
+        with pytest.warns(UserWarning, match="registered objects or their options changed"):
+            statements = compile_sql(manager)
+        assert "registered_later" in statements
+
+    def test_stale_source(self, tmp_path) -> None:
+        source = """\
+        def bundled() -> int:
+            return 1
+        """
+        module = import_module(tmp_path / "bundled_module.py", source)
+        manager = plpy_man.PlpyMan()
+        manager.plpy_func(module.bundled)
+        bundle = str(tmp_path / "bundle.json")
+        manager.build(bundle)
+        manager.use_bundle(bundle)
+
+        (tmp_path / "bundled_module.py").write_text(textwrap.dedent(source).replace("1", "2"))
+        with pytest.warns(UserWarning, match="source of a registered object changed"):
+            statements = compile_sql(manager)
+        assert "return 2" in statements["bundled"]
+
+    def test_missing_bundle(self, tmp_path) -> None:
+        manager = plpy_man.PlpyMan()
+        manager.use_bundle(str(tmp_path / "missing.json"))
+        with pytest.warns(UserWarning, match="could not be read"):
+            compile_sql(manager)
+
+    def test_cli(self, tmp_path, monkeypatch) -> None:
+        import_module(
+            tmp_path / "cli_module.py",
+            """\
+            import plpy_man
+
+            manager = plpy_man.PlpyMan()
+
+            @manager.plpy_func
+            def from_cli() -> int:
+                return 1
+            """,
+        )
+        monkeypatch.syspath_prepend(str(tmp_path))
+        bundle = tmp_path / "bundle.json"
+        cli(["build", "cli_module", "--manager", "cli_module", "-o", str(bundle)])
+        assert "from_cli" in json.loads(bundle.read_text())["statements"]
+
+
+class TestRegistry:
+    def test_reregistering_replaces(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        def helper():
+            return 1
+
+        def registered(x: int) -> int:
+            return x
+
+        manager.to_gd(helper)
+        manager.to_gd(helper)
+        wrapper = manager.plpy_func(registered)
+        # e.g. the module defining the function was reloaded
+        manager.plpy_func(wrapper, volatility="IMMUTABLE")
+
+        statements = compile_sql(manager)
+        assert statements["_add_to_gd"].count('GD["helper"] = helper') == 1
+        assert list(statements) == ["_add_to_gd", "registered"]
+        assert "IMMUTABLE" in statements["registered"]
+        assert manager.get("registered") is registered
+
+    def test_function_and_aggregate_of_the_same_name(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        def total(x: int) -> int:
+            return x
+
+        def step(state: int, x: int) -> int:
+            return (state or 0) + x
+
+        manager.plpy_func(total)
+        manager.plpy_aggregate(type("total", (), {"step": staticmethod(step)}))
+        statements = compile_sql(manager)
+        assert "CREATE OR REPLACE FUNCTION total (x INTEGER)" in statements["total"]
+        assert "CREATE OR REPLACE AGGREGATE total (INTEGER)" in statements["aggregate:total"]
+
+    def test_internal_names(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        def plpy_man_stats() -> int:
+            return 1
+
+        with pytest.raises(ValueError, match="plpy_man_stats"):
+            manager.plpy_func(plpy_man_stats)
+        with pytest.raises(ValueError, match="plpy_man_stats"):
+            manager.plpy_trigger(plpy_man_stats, table="orders")
+        # Functions in another schema don't replace plpy_man's
+        manager.plpy_func(plpy_man_stats, schema="reports")
+
+    def test_replacing_signature(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        def changed(x: int) -> int:
+            return x
+
+        manager.plpy_func(changed)
+
+        def changed(x: str) -> str:  # noqa: F811
+            return x
+
+        manager.plpy_func(changed)
+        assert "changed (x VARCHAR)" in compile_sql(manager)["changed"]
+
+    def test_overloads(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func(overload=True)
+        def double(x: int) -> int:
+            return x * 2
+
+        int_double = double.__wrapped__
+
+        @manager.plpy_func(overload=True)
+        def double(x: str) -> str:  # noqa: F811
+            return x + x
+
+        statements = compile_sql(manager)
+        assert "double (x INTEGER)" in statements["double(INTEGER)"]
+        assert "double (x VARCHAR)" in statements["double(VARCHAR)"]
+        assert manager.get("double", [int]) is int_double
+        assert manager.get("double", ["varchar"]) is double.__wrapped__
+        with pytest.raises(KeyError):
+            manager.get("double")
+
+        manager.unregister("double", [Integer])
+        assert list(compile_sql(manager)) == ["_add_to_gd", "double"]
+        manager.unregister("double")
+        with pytest.raises(KeyError):
+            manager.unregister("double")
+
+    def test_schema(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func(schema="analytics", batched=True)
+        def triple(x: int) -> int:
+            return x * 3
+
+        statements = compile_sql(manager)
+        assert "CREATE OR REPLACE FUNCTION analytics.triple (x" in statements["analytics.triple"]
+        assert "FUNCTION analytics.triple_batch (x" in statements["analytics.triple"]
+        batch_sql = statements["analytics.triple"].split(";\n", 1)[1]
+        procedure, namespace = compile_body(batch_sql, {})
+        namespace["x"] = [1, 2]
+        assert procedure() == [3, 6]
+        assert manager.get("triple", schema="analytics")
+        with pytest.raises(KeyError):
+            manager.get("triple")
+
+
+class TestGDDependencies:
+    def test_minimal_closure(self, tmp_path, monkeypatch) -> None:
+        monkeypatch.syspath_prepend(str(tmp_path))
+        import_module(
+            tmp_path / "gd_util.py",
+            """\
+            import re
+
+            _WORDS = re.compile(r"\\w+")
+
+
+            def count_words(text):
+                return len(_WORDS.findall(text))
+
+
+            def not_needed():
+                return 0
+            """,
+        )
+        module = import_module(
+            tmp_path / "gd_app.py",
+            """\
+            import json
+            from gd_util import count_words as words
+
+            LIMIT = 10
+            NOT_NEEDED = 0
+
+
+            def summarize(text):
+                return json.dumps({"words": min(words(text), LIMIT)})
+            """,
+        )
+        manager = plpy_man.PlpyMan()
+        manager.to_gd(module.summarize, dependencies=True)
+        script = compile_sql(manager)["_add_to_gd"]
+        assert "not_needed" not in script and "NOT_NEEDED" not in script
+        for definition in ("import json", "import re", "LIMIT = 10", "count_words", "words = "):
+            assert definition in script
+        # Definitions come before the definitions that use them
+        assert script.index("import re") < script.index("_WORDS =") < script.index("def count")
+
+        gd_script = _prep_gd_script([module.summarize], [module.summarize])
+        GD = {}
+        exec(gd_script, {"GD": GD})
+        assert GD["summarize"]("one two three") == '{"words": 3}'
+
+    def test_shared_dependencies(self, tmp_path, monkeypatch) -> None:
+        monkeypatch.syspath_prepend(str(tmp_path))
+        module = import_module(
+            tmp_path / "gd_shared.py",
+            """\
+            def helper():
+                return 1
+
+
+            def first():
+                return helper()
+
+
+            def second():
+                return helper() + first()
+            """,
+        )
+        objs = [module.first, module.second, module.helper]
+        script = _prep_gd_script(objs, objs)
+        assert script.count("def helper") == script.count("def first") == 1
+        assert 'GD["helper"] = helper' in script
+
+    def test_plpython_globals(self) -> None:
+        # plpy is imported from the mocks by plpy_man.helpers, but PlPython defines it
+        script = _prep_gd_script(
+            [plpy_man.helpers.cached_execute], [plpy_man.helpers.cached_execute]
+        )
+        assert "import" not in script
+
+    def test_without_dependencies(self) -> None:
+        script = _prep_gd_script([plpy_man.helpers.cached_execute])
+        assert script.startswith("def cached_execute(")
+
+
+class TestInlineGD:
+    @staticmethod
+    def register(manager: plpy_man.PlpyMan) -> None:
+        def words(string):
+            return string.lower().split()
+
+        def slug(string):
+            return "-".join(GD["words"](string))
+
+        manager.to_gd(words)
+        manager.to_gd(slug)
+
+    def test_inlined(self) -> None:
+        manager = plpy_man.PlpyMan()
+        self.register(manager)
+
+        @manager.plpy_func(inline_gd=True)
+        def make_slug(title: str) -> str:
+            return GD["slug"](title) + GD["other"]
+
+        sql = compile_sql(manager)["make_slug"]
+        assert 'GD["slug"]' not in sql and 'GD["words"]' not in sql
+        # Objects the body doesn't use are left in the GD
+        assert 'GD["other"]' in sql
+        procedure, namespace = compile_body(sql, {"other": "!"})
+        for title, expected in [("Hello World", "hello-world!"), ("A b", "a-b!")]:
+            namespace["title"] = title
+            assert procedure() == expected
+
+    def test_disabled(self) -> None:
+        manager = plpy_man.PlpyMan()
+        self.register(manager)
+
+        @manager.plpy_func
+        def make_slug(title: str) -> str:
+            return GD["slug"](title)
+
+        assert 'GD["slug"](title)' in compile_sql(manager)["make_slug"]
+
+    def test_batched(self) -> None:
+        manager = plpy_man.PlpyMan()
+        self.register(manager)
+
+        @manager.plpy_func(inline_gd=True, batched=True)
+        def make_slug(title: str) -> str:
+            return GD["slug"](title)
+
+        sql = compile_sql(manager)["make_slug"]
+        batch_sql = sql[sql.index("CREATE OR REPLACE FUNCTION make_slug_batch") :]
+        procedure, namespace = compile_body(batch_sql, {})
+        namespace["title"] = ["Hello World", "A b"]
+        assert procedure() == ["hello-world", "a-b"]
+
+    def test_clash(self) -> None:
+        manager = plpy_man.PlpyMan()
+        self.register(manager)
+
+        @manager.plpy_func(inline_gd=True)
+        def make_slug(words: str) -> str:
+            return GD["slug"](words)
+
+        with pytest.raises(ValueError, match="words"):
+            compile_sql(manager)
+
+    def test_without_gd_loaded(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+        self.register(manager)
+
+        @manager.plpy_func(inline_gd=True)
+        def inlined_slug(title: str) -> str:
+            return GD["slug"](title)
+
+        manager.flush(db)
+        db.close()
+        engine = db.get_bind()
+        engine.dispose()  # The next connection is served by a backend with an empty GD
+        with engine.connect() as conn:
+            actual = conn.execute(text("SELECT inlined_slug('Hello World')")).one()
+        assert actual == ("hello-world",)
+
+
+class TestPackages:
+    @staticmethod
+    def write_package(directory: Path) -> None:
+        files = {
+            "shared_pkg/__init__.py": "VERSION = 1\n",
+            "shared_pkg/text/__init__.py": "",
+            "shared_pkg/text/slugs.py": """\
+                from .. import VERSION
+
+
+                def slug(title):
+                    return "-".join(title.lower().split()) + f"-v{VERSION}"
+                """,
+            # Not a package, so not uploaded
+            "shared_pkg/scripts/run.py": "",
+        }
+        for name, source in files.items():
+            path = directory / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(textwrap.dedent(source))
+
+    @pytest.fixture
+    def package(self, tmp_path, monkeypatch):
+        self.write_package(tmp_path)
+        monkeypatch.syspath_prepend(str(tmp_path))
+        import shared_pkg
+
+        yield shared_pkg
+        for name in [name for name in sys.modules if name.startswith("shared_pkg")]:
+            del sys.modules[name]
+
+    def test_modules_sql(self, package) -> None:
+        manager = plpy_man.PlpyMan()
+        manager.to_package(package)
+        statements = compile_sql(manager)
+        modules = re.findall(
+            r"\('([\w.]+)', (TRUE|FALSE), decode", statements["plpy_man_modules:shared_pkg"]
+        )
+        assert modules == [
+            ("shared_pkg", "TRUE"),
+            ("shared_pkg.text", "TRUE"),
+            ("shared_pkg.text.slugs", "FALSE"),
+        ]
+        assert "plpy_man_import_hook" in statements
+
+    def test_prologue(self, package) -> None:
+        manager = plpy_man.PlpyMan()
+        manager.to_package("shared_pkg.text")
+
+        @manager.plpy_func
+        def make_slug(title: str) -> str:
+            from shared_pkg.text.slugs import slug
+
+            return slug(title)
+
+        @manager.plpy_func
+        def no_imports(title: str) -> str:
+            return title
+
+        statements = compile_sql(manager)
+        assert "SELECT plpy_man_import_hook()" in statements["make_slug"]
+        assert "plpy_man_import_hook" not in statements["no_imports"]
+        # The parent package is uploaded empty
+        assert "('shared_pkg', TRUE, '')" in statements["plpy_man_modules:shared_pkg.text"]
+
+    def test_finder(self, package) -> None:
+        manager = plpy_man.PlpyMan()
+        manager.to_package(package)
+        statements = compile_sql(manager)
+        rows = {
+            name: {"is_package": is_package == "TRUE", "source": base64.b64decode(source)}
+            for name, is_package, source in re.findall(
+                r"\('([\w.]+)', (TRUE|FALSE), decode\('([^']*)', 'base64'\)\)",
+                statements["plpy_man_modules:shared_pkg"],
+            )
+        }
+
+        class Plpy:
+            queried: List[str] = []
+
+            @staticmethod
+            def prepare(query, argtypes):
+                return query
+
+            @classmethod
+            def execute(cls, plan, args):
+                cls.queried.append(args[0])
+                return [rows[args[0]]] if args[0] in rows else []
+
+        # The package is only in the "database"
+        for name in [name for name in sys.modules if name.startswith("shared_pkg")]:
+            del sys.modules[name]
+        sys.path.remove(str(Path(package.__file__).parent.parent))
+        hook, _ = compile_body(statements["plpy_man_import_hook"], {}, Plpy)
+        meta_path = list(sys.meta_path)
+        try:
+            hook()
+            from shared_pkg.text.slugs import slug
+
+            assert slug("Hello World") == "hello-world-v1"
+            assert Plpy.queried == ["shared_pkg", "shared_pkg.text", "shared_pkg.text.slugs"]
+            assert "shared_pkg.scripts" not in sys.modules
+        finally:
+            sys.meta_path[:] = meta_path
+
+    def test_not_python(self) -> None:
+        with pytest.raises(ValueError, match="sys"):
+            plpy_man.PlpyMan().to_package("sys")
+
+    def test_import_in_database(self, db, package) -> None:
+        manager = plpy_man.PlpyMan()
+        manager.to_package(package)
+
+        @manager.plpy_func
+        def imported_slug(title: str) -> str:
+            from shared_pkg.text.slugs import slug
+
+            return slug(title)
+
+        manager.flush(db)
+        actual = db.execute(text("SELECT imported_slug('Hello World')")).one()
+        assert actual == ("hello-world-v1",)
+
+
+class TestGDData:
+    @staticmethod
+    def database(statements: dict, GD: dict):
+        """ A plpy serving the plpy_man_data rows of the statements and running the loader """
+        rows = {}
+        for name, sql in statements.items():
+            if name.startswith("plpy_man_data:"):
+                match = re.search(r"VALUES \('(\w+)', '(\w+)', '(\w+)', decode\('([^']*)'", sql)
+                key, serializer, version, data = match.groups()
+                rows[key] = {
+                    "name": key,
+                    "serializer": serializer,
+                    "version": version,
+                    "data": base64.b64decode(data),
+                }
+
+        class Plpy:
+            loads: List[str] = []
+
+            @staticmethod
+            def prepare(query, argtypes):
+                return query
+
+            @classmethod
+            def execute(cls, query, args=()):
+                if query.startswith("SELECT plpy_man_load_data("):
+                    cls.loads.append(query)
+                    names = re.findall(r"'(\w+)'", query)
+                    loader, namespace = compile_body(statements["plpy_man_load_data"], GD, cls)
+                    namespace["names"] = names
+                    return loader()
+                return [rows[name] for name in args[0] if name in rows]
+
+        return Plpy
+
+    def test_loaded_once(self) -> None:
+        manager = plpy_man.PlpyMan()
+        manager.to_gd_data("wages", {"ann": 10, "bob": 20})
+        manager.to_gd_data("unused", [1, 2, 3])
+
+        @manager.plpy_func
+        def wage(name: str) -> int:
+            return GD["wages"][name]
+
+        statements = compile_sql(manager)
+        GD: dict = {}
+        plpy = self.database(statements, GD)
+        procedure, namespace = compile_body(statements["wage"], GD, plpy)
+        for name, expected in [("ann", 10), ("bob", 20)]:
+            namespace["name"] = name
+            assert procedure() == expected
+        assert plpy.loads == ["SELECT plpy_man_load_data('wages')"]
+        assert "unused" not in GD
+
+        # Changed data is loaded again by backends that loaded the old version
+        manager.to_gd_data("wages", {"ann": 11})
+        statements = compile_sql(manager)
+        new_plpy = self.database(statements, GD)
+        procedure, namespace = compile_body(statements["wage"], GD, new_plpy)
+        namespace["name"] = "ann"
+        assert procedure() == 11
+
+    def test_serializer(self) -> None:
+        manager = plpy_man.PlpyMan()
+        manager.to_gd_data("limits", {"max": 5}, serializer=json)
+        sql = compile_sql(manager)["plpy_man_data:limits"]
+        assert "'limits', 'json'" in sql
+        with pytest.raises(TypeError):
+            manager.to_gd_data("limits", {}, serializer=textwrap)
+        with pytest.raises(ValueError):
+            manager.to_gd_data("not a name", {})
+
+    def test_serialized_once(self) -> None:
+        dumped = []
+
+        def dumps(obj):
+            dumped.append(obj)
+            return json.dumps(obj)
+
+        serializer = SimpleNamespace(__name__="json", dumps=dumps, loads=json.loads)
+        manager = plpy_man.PlpyMan()
+        manager.to_gd_data("limits", {"max": 5}, serializer=serializer)
+        manager.data_sizes()
+        manager.diff(TestDiff.Catalog([]))
+        manager.diff(TestDiff.Catalog([]))
+        compile_sql(manager)
+        assert dumped == [{"max": 5}]
+        # Registering again serializes the new object
+        manager.to_gd_data("limits", {"max": 6}, serializer=serializer)
+        compile_sql(manager)
+        assert dumped == [{"max": 5}, {"max": 6}]
+
+    def test_changed_after_serializing(self) -> None:
+        manager = plpy_man.PlpyMan()
+        limits = {"max": 5}
+        manager.to_gd_data("limits", limits, serializer=json)
+        manager.data_sizes()
+        limits["max"] = 6
+        assert '{"max": 5}' in self.stored(manager)
+        manager.to_gd_data("limits", limits, serializer=json)
+        assert '{"max": 6}' in self.stored(manager)
+
+    @staticmethod
+    def stored(manager: plpy_man.PlpyMan) -> str:
+        sql = compile_sql(manager)["plpy_man_data:limits"]
+        data = re.search(r"decode\('([^']*)'", sql).group(1)
+        return base64.b64decode(data).decode()
+
+    def test_size_limit(self) -> None:
+        manager = plpy_man.PlpyMan()
+        manager.to_gd_data("table", list(range(1000)), size_limit=1000)
+        assert manager.data_sizes()["table"] > 1000
+        with pytest.warns(UserWarning, match="table"):
+            compile_sql(manager)
+
+    def test_size_warning_is_shown(self) -> None:
+        # Python's default filters hide some categories of warnings, such as ResourceWarning
+        script = textwrap.dedent(
+            """
+            import plpy_man
+            manager = plpy_man.PlpyMan()
+            manager.to_gd_data("table", list(range(1000)), size_limit=1000)
+            manager._compile()
+            """
+        )
+        env = {key: value for key, value in os.environ.items() if key != "PYTHONWARNINGS"}
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parents[1],
+            env=env,
+        )
+        assert "The GD data table is" in result.stderr
+
+    def test_clash(self) -> None:
+        manager = plpy_man.PlpyMan()
+
+        def wages():
+            return {}
+
+        manager.to_gd(wages)
+        manager.to_gd_data("wages", {})
+        with pytest.raises(ValueError, match="wages"):
+            compile_sql(manager)
+
+    def test_in_database(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+        manager.to_gd_data("data_wages", {"ann": 10})
+
+        @manager.plpy_func
+        def data_wage(name: str) -> int:
+            return GD["data_wages"][name]
+
+        manager.flush(db)
+        assert db.execute(text("SELECT data_wage('ann')")).one() == (10,)
+
+
+class TestDiff:
+    class Catalog:
+        """ Answers the diff query like Postgres would, for a few types """
+
+        TYPES = {"VARCHAR": "character varying", "INTEGER": "integer", "INTEGER[]": "integer[]"}
+
+        def __init__(self, functions: List[list]) -> None:
+            self.functions = functions
+            self.queries = 0
+
+        def execute(self, statement, params):
+            self.queries += 1
+            types = {t: self.TYPES.get(t, t.lower()) for t in params["types"]}
+            names = set(params["names"])
+            functions = [f for f in self.functions if f[1] in names]
+
+            class Result:
+                @staticmethod
+                def one():
+                    return types, functions
+
+            return Result()
+
+    @staticmethod
+    def register(manager: plpy_man.PlpyMan) -> Callable:
+        @manager.plpy_func(batched=True)
+        def add_one(number: int) -> int:
+            return number + 1
+
+        return add_one
+
+    def test_defined_functions(self) -> None:
+        manager = plpy_man.PlpyMan()
+        self.register(manager)
+
+        @manager.plpy_func(argtypes=["NUMERIC(10, 2)", "TEXT"], rettype="TABLE(a INTEGER)")
+        def rows(amount, label):
+            return []
+
+        statements = compile_sql(manager)
+        add_one, add_one_batch = plpy_man.manager._defined_functions(statements["add_one"])
+        assert add_one[:4] == (None, "add_one", ("INTEGER",), "INTEGER")
+        assert add_one.source == "\n    return number + 1\n"
+        assert add_one_batch[:4] == (None, "add_one_batch", ("INTEGER[]",), "INTEGER[]")
+        (function,) = plpy_man.manager._defined_functions(statements["rows"])
+        assert function.argtypes == ("NUMERIC(10, 2)", "TEXT")
+        assert (function.rettype, function.retset) == ("record", True)
+
+    def test_diff(self) -> None:
+        manager = plpy_man.PlpyMan()
+        self.register(manager)
+        add_one, add_one_batch = plpy_man.manager._defined_functions(
+            compile_sql(manager)["add_one"]
+        )
+        catalog = self.Catalog(
+            [
+                ["public", "add_one", True, ["integer"], "integer", False, add_one.source],
+                ["public", "add_one", True, ["character varying"], "integer", False, ""],
+                ["public", "add_one_batch", True, ["integer[]"], "integer[]", False, "old"],
+                ["other", "add_one", False, ["integer"], "integer", False, "not visible"],
+            ]
+        )
+        assert manager.diff(catalog) == {
+            "missing": ["_add_to_gd()"],
+            "stale": ["add_one_batch(integer[])"],
+            "orphaned": ["public.add_one(character varying)"],
+        }
+        assert catalog.queries == 1
+
+    def test_cached(self, monkeypatch) -> None:
+        manager = plpy_man.PlpyMan()
+        self.register(manager)
+        catalog = self.Catalog([])
+        manager.diff(catalog)
+        generated = []
+        monkeypatch.setattr(manager, "_generate", lambda *args: generated.append(args) or {})
+        manager.diff(catalog)
+        assert not generated
+        manager.unregister("add_one")
+        manager.diff(catalog)
+        assert generated
+
+    def test_in_database(self, db) -> None:
+        manager = plpy_man.PlpyMan()
+
+        @manager.plpy_func
+        def diffed(number: int) -> int:
+            return number + 1
+
+        manager.flush(db)
+        manager.plpy_func(diffed)
+        assert manager.diff(db) == {"missing": [], "stale": [], "orphaned": []}
+
+        for argtype in ("INTEGER", "TEXT"):
+            db.execute(
+                text(
+                    f"CREATE OR REPLACE FUNCTION diffed(number {argtype}) RETURNS INTEGER "
+                    f"AS $$ return 0 $$ LANGUAGE plpython3u"
+                )
+            )
+        assert manager.diff(db) == {
+            "missing": [],
+            "stale": ["diffed(integer)"],
+            "orphaned": ["public.diffed(text)"],
+        }
+        db.rollback()
+
+
 if __name__ == "__main__":
     pytest.main()